@@ -0,0 +1,323 @@
+# Plan batches of a sequence of utterance lengths (durations or text lengths)
+# in their given order, so that each batch fits a capacity, i.e. batch size x
+# the longest length in the batch, and report the resulting padding rate.
+#
+# Policies:
+#   greedy   fill each batch as far as it fits, as get_batch_sizes always did
+#   optimal  fewest batches, and with the fewest batches the least padding
+#
+# plan_memory and plan_attention instead fill batches by the text and mel
+# lengths, up to a memory budget under a fitted memory model (see
+# memory_model.py) or up to a budget of attention compute B x T_in x T_out.
+#
+# Example (report the padding rate of the plan of a train set):
+#   python batch_plan.py -f filelists/ljspeech/ljspeech_wav_train.txt \
+#     --hparams "permute_opt=semi-sort,batch_size=32"
+
+import os
+import argparse
+import array
+import collections
+import time
+import numpy as np
+
+
+def get_capacity(lengths, batch_size):
+    """batch_size x mean of the batch_size longest lengths (of all lengths if
+    fewer), summed in descending order as get_batch_sizes always did, so
+    the capacity and the plans are bit for bit the same"""
+    longest = np.sort(np.asarray(lengths))[::-1][:batch_size].copy()
+    return float(batch_size * np.mean(longest))
+
+
+def plan_greedy(lengths, capacity):
+    """add samples to a batch while the running max x batch size fits the
+    capacity, in one pass. A sample longer than the capacity is a batch of
+    its own."""
+    batch_sizes = []
+    batch_max, batch_size = 0.0, 0
+    for length in np.asarray(lengths, dtype=np.float64).tolist():
+        new_max = max(batch_max, length)
+        if batch_size > 0 and new_max * (batch_size + 1) > capacity:
+            batch_sizes.append(batch_size)
+            new_max, batch_size = length, 0
+        batch_max, batch_size = new_max, batch_size + 1
+    if batch_size > 0:
+        batch_sizes.append(batch_size)
+    return batch_sizes
+
+
+class RangeMax():
+    """max of lengths[i:j] for j - i <= max_width, in O(1) per query"""
+    def __init__(self, lengths, max_width):
+        levels = [lengths]
+        width = 1
+        while width * 2 <= max_width:
+            levels.append(np.maximum(levels[-1][:-width], levels[-1][width:]))
+            width *= 2
+        # element access of array.array is much faster than of numpy arrays
+        self.levels = [array.array('d', level) for level in levels]
+
+    def __call__(self, i, j):
+        k = (j - i).bit_length() - 1
+        level = self.levels[k]
+        return max(level[i], level[j - (1 << k)])
+
+
+def plan_optimal(lengths, capacity):
+    """partition lengths (in order) into batches which fit the capacity with
+    the fewest batches and, among those, the least total area (padding).
+
+    DP over batch ends with cost(i, j) = (1, (j - i) x max(lengths[i:j])).
+    For lengths sorted in descending order the cost is Monge, so the best
+    batch start is monotone in the batch end and the DP runs in
+    O(N log W) (W: widest batch) with a deque of candidate starts. In any
+    other order (e.g. semi-sorted) the plan is still valid but may not be
+    exactly optimal."""
+    lengths = np.asarray(lengths, dtype=np.float64)
+    n = len(lengths)
+    if n == 0:
+        return []
+    max_width = max(1, int(capacity // lengths.min())) if lengths.min() > 0 else n
+    max_width = min(max_width, n)
+    range_max = RangeMax(lengths, max_width)
+    lengths = array.array('d', lengths)
+    inf = (float('inf'), float('inf'))
+    counts, areas = [0] * (n + 1), [0.0] * (n + 1)
+    starts = [0] * (n + 1)
+
+    def cost(i, j):
+        """(#batches, area) of the best plan of lengths[:j] ending with
+        the batch lengths[i:j]"""
+        width = j - i
+        if width > 1:
+            if width > max_width:
+                return inf
+            area = width * range_max(i, j)
+            if area > capacity:
+                return inf
+        else:
+            area = lengths[i]
+        return (counts[i] + 1, areas[i] + area)
+
+    # candidates: [start i, first batch end from which i is the best start]
+    candidates = collections.deque([[0, 1]])
+    for j in range(1, n + 1):
+        while len(candidates) > 1 and candidates[1][1] <= j:
+            candidates.popleft()
+        i = candidates[0][0]
+        best = cost(i, j)
+        if best == inf:
+            # lengths not sorted, fall back to the previous sample only
+            i, best = j - 1, cost(j - 1, j)
+        counts[j], areas[j] = best
+        starts[j] = i
+        if j == n:
+            break
+        # add j as a start, it wins from some batch end on (ties to j)
+        while len(candidates) > 0:
+            c, pos = candidates[-1]
+            pos = max(pos, j + 1)
+            if cost(j, pos) <= cost(c, pos):
+                candidates.pop()
+            else:
+                break
+        if len(candidates) == 0:
+            candidates.append([j, j + 1])
+            continue
+        c, pos = candidates[-1]
+        lo, hi = max(pos, j + 1), min(n, j + max_width + 1)
+        if cost(j, hi) > cost(c, hi):
+            continue
+        while lo < hi: # first batch end where j is at least as good as c
+            mid = (lo + hi) // 2
+            if cost(j, mid) <= cost(c, mid):
+                hi = mid
+            else:
+                lo = mid + 1
+        candidates.append([j, lo])
+
+    batch_sizes = []
+    j = n
+    while j > 0:
+        batch_sizes.append(j - starts[j])
+        j = starts[j]
+    return batch_sizes[::-1]
+
+
+def plan_cost(text_lengths, mel_lengths, cost, budget):
+    """add samples to a batch while cost(B, max text length, max mel length)
+    of the batch fits the budget, in one pass. cost must be monotone."""
+    batch_sizes = []
+    max_text, max_mel, batch_size = 0.0, 0.0, 0
+    for text_len, mel_len in zip(np.asarray(text_lengths, dtype=np.float64).tolist(),
+                                 np.asarray(mel_lengths, dtype=np.float64).tolist()):
+        new_text, new_mel = max(max_text, text_len), max(max_mel, mel_len)
+        if batch_size > 0 and cost(batch_size + 1, new_text, new_mel) > budget:
+            batch_sizes.append(batch_size)
+            new_text, new_mel, batch_size = text_len, mel_len, 0
+        max_text, max_mel, batch_size = new_text, new_mel, batch_size + 1
+    if batch_size > 0:
+        batch_sizes.append(batch_size)
+    return batch_sizes
+
+
+def plan_memory(text_lengths, mel_lengths, memory_model, memory_budget):
+    """batches whose memory predicted by memory_model(B, max text length,
+    max mel length) fits memory_budget"""
+    return plan_cost(text_lengths, mel_lengths, memory_model, memory_budget)
+
+
+def attention_cost(batch_size, text_len, mel_len):
+    """compute of a padded batch: encoder B T_in + attention B T_out T_in"""
+    return batch_size * text_len * (1 + mel_len)
+
+
+def get_attention_capacity(text_lengths, mel_lengths, batch_size):
+    """batch_size x mean attention cost of the batch_size costliest samples"""
+    costs = attention_cost(1, np.asarray(text_lengths, dtype=np.float64),
+                           np.asarray(mel_lengths, dtype=np.float64))
+    return get_capacity(costs, batch_size)
+
+
+def plan_attention(text_lengths, mel_lengths, capacity):
+    """batches whose padded attention cost fits the capacity"""
+    return plan_cost(text_lengths, mel_lengths, attention_cost, capacity)
+
+
+POLICIES = {'greedy': plan_greedy, 'optimal': plan_optimal}
+
+
+def plan_batches(lengths, capacity, policy='greedy'):
+    """batch sizes of lengths in their order with the given policy"""
+    if policy not in POLICIES:
+        raise ValueError('unknown batch policy {}'.format(policy))
+    return POLICIES[policy](lengths, capacity)
+
+
+def save_plan(path, plan):
+    """save a plan of sample ids, or of lists of sample ids per batch, as
+    flat ids and batch offsets"""
+    batched = len(plan) > 0 and isinstance(plan[0], (list, tuple))
+    if batched:
+        ids = np.fromiter((i for batch in plan for i in batch), dtype=np.int64)
+        offsets = np.cumsum([0] + [len(batch) for batch in plan], dtype=np.int64)
+    else:
+        ids = np.asarray(plan, dtype=np.int64)
+        offsets = np.zeros(0, dtype=np.int64)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    path_tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(path_tmp, 'wb') as f:
+        np.savez(f, ids=ids, offsets=offsets, batched=batched)
+    os.replace(path_tmp, path)
+
+
+def load_plan(path):
+    """load a plan saved by save_plan"""
+    with np.load(path) as f:
+        ids = f['ids'].tolist()
+        if not bool(f['batched']):
+            return ids
+        offsets = f['offsets'].tolist()
+    return [ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def padding_rate(lengths, batch_sizes):
+    """fraction of padding in the batches, i.e. 1 - sum of lengths / sum of
+    batch size x max length per batch"""
+    lengths = np.asarray(lengths, dtype=np.float64)
+    batch_sizes = np.asarray(batch_sizes, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(batch_sizes)[:-1]])
+    area = np.sum(np.maximum.reduceat(lengths, offsets) * batch_sizes)
+    return 1 - lengths.sum() / area
+
+
+def attention_padding_rate(text_lengths, mel_lengths, batch_sizes):
+    """fraction of padding in the attention (B x T_out x T_in) of batches"""
+    text_lengths = np.asarray(text_lengths, dtype=np.float64)
+    mel_lengths = np.asarray(mel_lengths, dtype=np.float64)
+    batch_sizes = np.asarray(batch_sizes, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(batch_sizes)[:-1]])
+    area = np.sum(np.maximum.reduceat(text_lengths, offsets) *
+                  np.maximum.reduceat(mel_lengths, offsets) * batch_sizes)
+    return 1 - np.sum(text_lengths * mel_lengths) / area
+
+
+def report(lengths, capacity, policies=('greedy', 'optimal'),
+           text_lengths=None, mel_lengths=None, attention_capacity=None):
+    """print batch counts and padding rates of plans of the key lengths and,
+    with text and mel lengths, of the attention policy"""
+    print('{} samples, capacity {:.1f}'.format(len(lengths), capacity))
+    plans = []
+    for policy in policies:
+        start = time.perf_counter()
+        batch_sizes = plan_batches(lengths, capacity, policy)
+        plans.append((policy, batch_sizes, time.perf_counter() - start))
+    if text_lengths is not None:
+        start = time.perf_counter()
+        batch_sizes = plan_attention(text_lengths, mel_lengths,
+                                     attention_capacity)
+        plans.append(('attention', batch_sizes, time.perf_counter() - start))
+    for policy, batch_sizes, duration in plans:
+        print('  {:<9s} {} batches (mean size {:.1f}), padding rate {:.2f}%'.format(
+              policy, len(batch_sizes), np.mean(batch_sizes),
+              padding_rate(lengths, batch_sizes) * 100), end='')
+        if text_lengths is not None:
+            print(' (text {:.2f}%, attention {:.2f}%)'.format(
+                padding_rate(text_lengths, batch_sizes) * 100,
+                attention_padding_rate(text_lengths, mel_lengths,
+                                       batch_sizes) * 100), end='')
+        print(', planned in {:.2f}s'.format(duration))
+
+
+def parse_args():
+    usage = 'report the padding rate of batch plans of a filelist'
+    parser = argparse.ArgumentParser(description=usage)
+    parser.add_argument('-f', '--filelist', type=str, required=True,
+                        help='filelist to plan batches of')
+    parser.add_argument('--hparams', type=str, required=False,
+                        help='comma separated name=value pairs')
+    parser.add_argument('--epoch', type=int, default=0,
+                        help='epoch of the plan if prep_trainset_per_epoch')
+    return parser.parse_args()
+
+
+def main():
+    from hparams import create_hparams
+    from utils import load_filepaths_and_text, get_key_values
+    from utils import permute_filelist_idxs, get_text_mel_lengths
+    args = parse_args()
+    hparams = create_hparams(args.hparams)
+    filelist = load_filepaths_and_text(args.filelist)
+    seed = hparams.seed
+    if hparams.prep_trainset_per_epoch:
+        seed += args.epoch
+    if hparams.shuffle_audiopaths:
+        idxs = permute_filelist_idxs(filelist, hparams.filelist_cols, seed,
+            hparams.permute_opt, hparams.local_rand_factor,
+            hparams.bucket_width, hparams.text_bucket_width)[0]
+        filelist = [filelist[i] for i in idxs]
+    lengths, key = get_key_values(filelist, hparams.filelist_cols)
+    attention_budget = 0
+    if hparams.batch_policy == 'attention':
+        capacity = get_capacity(lengths, hparams.batch_size)
+        attention_budget = hparams.batch_budget
+    else:
+        capacity = hparams.batch_budget or get_capacity(lengths, hparams.batch_size)
+    print('planning by {} in the order of permute_opt={}'.format(key,
+        hparams.permute_opt if hparams.shuffle_audiopaths else 'none'))
+    text_lengths = mel_lengths = attention_capacity = None
+    if 'dur' in hparams.filelist_cols:
+        hop_length = hparams.hop_length
+        if hparams.override_sample_size:
+            hop_length = int(np.ceil(hparams.hop_time/1000*hparams.sampling_rate))
+        text_lengths, mel_lengths = get_text_mel_lengths(filelist,
+            hparams.filelist_cols, hparams.sampling_rate / hop_length)
+        attention_capacity = attention_budget or get_attention_capacity(
+            text_lengths, mel_lengths, hparams.batch_size)
+    report(lengths, capacity, text_lengths=text_lengths,
+           mel_lengths=mel_lengths, attention_capacity=attention_capacity)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+# Micro-benchmarks of data pipeline components against their previous
+# implementations
+#
+# Example:
+#   python benchmark.py --target collate --batch-size 64 --repeat 50
+#   python benchmark.py --target wav --wav-dir LJSpeech-1.1/wavs --repeat 5
+#   python benchmark.py --target mel --repeat 5
+#   python benchmark.py --target emr --repeat 5
+#
+# Every target first checks that the new implementation gives the outputs of
+# the previous one (bitwise, or within --tol for float results of batched
+# computations), and fails with an AssertionError (non-zero exit) otherwise.
+
+import os
+import sys
+import glob
+import argparse
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.io.wavfile import read, write
+
+from data_utils import TextMelCollate
+from utils import load_wav_norm, load_wav_to_torch
+from layers import TacotronSTFT
+
+# include audio emotion recognition directory into search path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emr'))
+from models_embed import SequenceWise, Layered_RNN
+
+
+def legacy_collate(batch, n_frames_per_step=1, label_type='one-hot', use_vae=False):
+    """the loop-based TextMelCollate.__call__ before vectorization"""
+    input_lengths, ids_sorted_decreasing = torch.sort(
+        torch.LongTensor([len(x[0]) for x in batch]),
+        dim=0, descending=True)
+    max_input_len = input_lengths[0]
+
+    text_padded = torch.LongTensor(len(batch), max_input_len)
+    text_padded.zero_()
+    for i in range(len(ids_sorted_decreasing)):
+        text = batch[ids_sorted_decreasing[i]][0]
+        text_padded[i, :text.size(0)] = text
+
+    if use_vae:
+        if label_type == 'one-hot':
+            speakers = torch.LongTensor(len(batch), len(batch[0][3]))
+            for i in range(len(ids_sorted_decreasing)):
+                speakers[i, :] = batch[ids_sorted_decreasing[i]][3]
+            emotions = torch.LongTensor(len(batch), len(batch[0][4]))
+            for i in range(len(ids_sorted_decreasing)):
+                emotions[i, :] = batch[ids_sorted_decreasing[i]][4]
+        elif label_type == 'id':
+            speakers = torch.LongTensor(len(batch))
+            emotions = torch.LongTensor(len(batch))
+            for i in range(len(ids_sorted_decreasing)):
+                speakers[i] = batch[ids_sorted_decreasing[i]][3]
+                emotions[i] = batch[ids_sorted_decreasing[i]][4]
+    else:
+        speakers = emotions = ''
+
+    durs = [[] for _ in range(len(batch))]
+    audioids = [[] for _ in range(len(batch))]
+    for i in range(len(ids_sorted_decreasing)):
+        durs[i] = batch[ids_sorted_decreasing[i]][5]
+        audioids[i] = batch[ids_sorted_decreasing[i]][6]
+
+    num_mels = batch[0][1].size(0)
+    max_target_len = max([x[1].size(1) for x in batch])
+    if len(batch[0][2]) > 0:
+        num_emoembs = batch[0][2].size(0)
+    if max_target_len % n_frames_per_step != 0:
+        max_target_len += n_frames_per_step - max_target_len % n_frames_per_step
+
+    mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
+    mel_padded.zero_()
+    gate_padded = torch.FloatTensor(len(batch), max_target_len)
+    gate_padded.zero_()
+    output_lengths = torch.LongTensor(len(batch))
+    for i in range(len(ids_sorted_decreasing)):
+        mel = batch[ids_sorted_decreasing[i]][1]
+        mel_padded[i, :, :mel.size(1)] = mel
+        gate_padded[i, mel.size(1)-1:] = 1
+        output_lengths[i] = mel.size(1)
+
+    if len(batch[0][2]) > 0:
+        emoemb_padded = torch.FloatTensor(len(batch), num_emoembs, max_target_len)
+        emoemb_padded.zero_()
+        for i in range(len(ids_sorted_decreasing)):
+            emoemb = batch[ids_sorted_decreasing[i]][2]
+            emoemb_nframes = min(emoemb.size(1), max_target_len)
+            emoemb_padded[i, :, :emoemb_nframes] = emoemb[:, :emoemb_nframes]
+    else:
+        emoemb_padded = ''
+
+    return text_padded, input_lengths, mel_padded, emoemb_padded, \
+        gate_padded, output_lengths, speakers, emotions, durs, audioids
+
+
+def make_batch(batch_size, n_mel_channels=80, emo_emb_dim=64, n_speakers=2,
+               n_emotions=4, include_emo_emb=True, seed=0):
+    """synthetic batch with the item layout of TextMelLoader.get_mel_text_pair"""
+    rng = np.random.RandomState(seed)
+    batch = []
+    for i in range(batch_size):
+        text_len = rng.randint(20, 200)
+        mel_len = rng.randint(100, 900)
+        text = torch.IntTensor(rng.randint(1, 60, text_len))
+        mel = torch.randn(n_mel_channels, mel_len)
+        emoemb = torch.randn(emo_emb_dim, mel_len // 2) if include_emo_emb else ''
+        speaker, emotion = rng.randint(n_speakers), rng.randint(n_emotions)
+        batch.append((text, mel, emoemb, speaker, emotion, mel_len * 0.0125,
+                      'audio{}'.format(i)))
+    return batch
+
+
+def legacy_labels(batch, n_speakers, n_emotions):
+    """replace label indices of a batch by the per-sample one-hot vectors of
+    TextMelLoader.get_speaker/get_emotion before the label ids"""
+    legacy_batch = []
+    for x in batch:
+        speaker, emotion = torch.zeros(n_speakers), torch.zeros(n_emotions)
+        speaker[x[3]], emotion[x[4]] = 1, 1
+        legacy_batch.append(x[:3] + (speaker, emotion) + x[5:])
+    return legacy_batch
+
+
+def timeit(fn, repeat):
+    fn() # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_collate(args):
+    hparams = argparse.Namespace(n_frames_per_step=1, label_type='one-hot',
+                                 use_vae=True, n_speakers=args.n_speakers,
+                                 n_emotions=4)
+    batch = make_batch(args.batch_size, n_speakers=args.n_speakers)
+    # the legacy collate gets per-sample one-hot labels, as before
+    batches = {'legacy': legacy_labels(batch, hparams.n_speakers,
+                                       hparams.n_emotions)}
+    collates = {'legacy': lambda b: legacy_collate(b, 1, 'one-hot', True),
+                'vectorized': TextMelCollate(hparams)}
+
+    # check all implementations produce the same outputs
+    reference = collates['legacy'](batches['legacy'])
+    for name, collate in collates.items():
+        outputs = collate(batches.get(name, batch))
+        for ref, out in zip(reference, outputs):
+            if isinstance(ref, torch.Tensor):
+                assert torch.equal(ref, out), '{} output mismatch'.format(name)
+            else:
+                assert ref == out, '{} output mismatch'.format(name)
+
+    print('collate, batch size {}, {} repeats'.format(args.batch_size, args.repeat))
+    for name, collate in collates.items():
+        duration = timeit(lambda: collate(batches.get(name, batch)), args.repeat)
+        print('  {:<16s} {:8.3f} ms/batch'.format(name, duration * 1000))
+
+
+def legacy_load_wav(full_path, max_wav_value):
+    """utils.load_wav_to_torch followed by the normalization, as in
+    TextMelLoader.get_audio before load_wav_norm"""
+    audio, sampling_rate = load_wav_to_torch(full_path)
+    return audio / max_wav_value, sampling_rate
+
+
+def make_wavs(wav_dir, n_files=20, duration=8.0, sampling_rate=22050, seed=0):
+    """synthetic int16 wav files"""
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(n_files):
+        data = rng.randint(-32768, 32768, int(duration * sampling_rate))
+        path = os.path.join(wav_dir, 'audio{}.wav'.format(i))
+        write(path, sampling_rate, data.astype(np.int16))
+        paths.append(path)
+    return paths
+
+
+def bench_wav(args):
+    max_wav_value = 32768.0
+    tmp_dir = None
+    if args.wav_dir:
+        paths = sorted(glob.glob(os.path.join(args.wav_dir, '*.wav')))[:args.n_files]
+    else:
+        tmp_dir = tempfile.TemporaryDirectory()
+        paths = make_wavs(tmp_dir.name, args.n_files)
+    assert len(paths) > 0, 'no wav files found'
+    crop_end = read(paths[0])[0] # first second only, e.g. cropped references
+    readers = {'legacy': lambda p: legacy_load_wav(p, max_wav_value),
+               'mmap+fused': lambda p: load_wav_norm(p, max_wav_value),
+               'mmap+fused 1s': lambda p: load_wav_norm(p, max_wav_value,
+                                                        0, crop_end)}
+
+    # check the readers produce the same samples
+    for path in paths:
+        reference = readers['legacy'](path)[0]
+        assert torch.equal(reference, readers['mmap+fused'](path)[0]), \
+            'mmap+fused output mismatch in {}'.format(path)
+        assert torch.equal(reference[:crop_end], readers['mmap+fused 1s'](path)[0]), \
+            'mmap+fused 1s output mismatch in {}'.format(path)
+
+    nbytes = np.mean([os.path.getsize(p) for p in paths])
+    print('wav, {} files of {:.1f} MB on average, {} repeats'.format(
+        len(paths), nbytes / 1024**2, args.repeat))
+    for name, reader in readers.items():
+        duration = timeit(lambda: [reader(p) for p in paths], args.repeat)
+        print('  {:<16s} {:8.3f} ms/file'.format(name, duration * 1000 / len(paths)))
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+def bench_mel(args):
+    stft = TacotronSTFT()
+    rng = np.random.RandomState(0)
+    audios = [torch.from_numpy(rng.uniform(-0.5, 0.5, rng.randint(22050, 22050*8))
+                               .astype(np.float32)) for _ in range(args.batch_size)]
+    legacy = lambda: [stft.mel_spectrogram(y.unsqueeze(0)).squeeze(0) for y in audios]
+    batched = lambda: stft.mel_spectrograms(audios)
+
+    # check the batched mels against the per-utterance ones
+    with torch.no_grad():
+        max_diff = 0.0
+        for ref, out in zip(legacy(), batched()):
+            assert ref.shape == out.shape, 'batched mel shape mismatch'
+            max_diff = max(max_diff, float((ref - out).abs().max()))
+    assert max_diff <= args.tol, 'batched mel mismatch: max abs diff {:.2e}'.format(
+        max_diff)
+
+    print('mel, {} clips of 1-8 s, max abs diff {:.2e}, {} repeats'.format(
+        len(audios), max_diff, args.repeat))
+    with torch.no_grad():
+        for name, fn in [('per-utterance', legacy), ('batched', batched)]:
+            duration = timeit(fn, args.repeat)
+            print('  {:<16s} {:8.3f} ms/clip'.format(name, duration * 1000 / len(audios)))
+
+
+def legacy_sequence_wise(module, x, input_sizes_list, T_max):
+    """SequenceWise.forward before the flat index gather and scatter"""
+    x = torch.cat([x[i, 0 : input_sizes_list[i]] for i in range(len(input_sizes_list))], dim = 0)
+    x = module(x)
+    start = 0
+    out = []
+    for length in input_sizes_list:
+        x_i = x[start : start + length]
+        num_pad = T_max - length
+        if num_pad > 0:
+            x_i = F.pad(x_i, pad = (0, 0, 0, num_pad), mode='constant', value = 0)
+        out.append(x_i)
+        start += length
+    return torch.stack(out, dim = 0)
+
+
+def bench_emr(args):
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    lengths = sorted(rng.randint(50, 500, args.batch_size).tolist(), reverse=True)
+
+    # SequenceWise must be bitwise equal to the previous implementation
+    module = SequenceWise(torch.nn.Linear(512, 256))
+    x = torch.randn(len(lengths), lengths[0], 512)
+    for T_max in [lengths[0], lengths[0] + 7]:
+        with torch.no_grad():
+            ref = legacy_sequence_wise(module.module, x, lengths, T_max)
+            out = module(x, lengths, T_max)
+        assert torch.equal(ref, out), 'SequenceWise output mismatch'
+
+    # batched get_embeds against get_embed (embed) one utterance at a time
+    with tempfile.NamedTemporaryFile('w', suffix='stats_emr') as stats:
+        stats.write('<MEAN> 123\n{}\n<VARIANCE> 123\n{}\n'.format(
+            ' '.join(['0.0'] * 123), ' '.join(['1.0'] * 123)))
+        stats.flush()
+        model = Layered_RNN(out_dim=64, stats_emr=stats.name).eval()
+    feats = [rng.randn(n, 123) for n in rng.permutation(lengths)]
+    legacy = lambda: [model.embed(feat) for feat in feats]
+    batched = lambda: model.get_embeds(feats)
+    with torch.no_grad():
+        max_diff = 0.0
+        for refs, outs in zip(legacy(), batched()):
+            for ref, out in zip(refs, outs):
+                ref, out = np.squeeze(ref), np.squeeze(out)
+                assert ref.shape == out.shape, 'get_embeds shape mismatch'
+                max_diff = max(max_diff, float(np.abs(ref - out).max()))
+    assert max_diff <= args.tol, 'get_embeds mismatch: max abs diff {:.2e}'.format(
+        max_diff)
+
+    print('emr, {} utterances of 50-500 frames, max abs diff {:.2e}, {} repeats'.format(
+        len(feats), max_diff, args.repeat))
+    with torch.no_grad():
+        for name, fn in [('per-utterance', legacy), ('batched', batched)]:
+            duration = timeit(fn, args.repeat)
+            print('  {:<16s} {:8.3f} ms/utterance'.format(name, duration * 1000 / len(feats)))
+
+
+def parse_args():
+    usage = 'micro-benchmarks of data pipeline components'
+    parser = argparse.ArgumentParser(description=usage)
+    parser.add_argument('--target', type=str, default='collate',
+                        choices=['collate', 'wav', 'mel', 'emr'])
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--n-speakers', type=int, default=2)
+    parser.add_argument('--wav-dir', type=str, default='',
+                        help='dir of wav files to read, synthetic files if empty')
+    parser.add_argument('--n-files', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--tol', type=float, default=1e-4,
+                        help='max abs difference of batched float outputs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.target == 'collate':
+        bench_collate(args)
+    elif args.target == 'wav':
+        bench_wav(args)
+    elif args.target == 'mel':
+        bench_mel(args)
+    elif args.target == 'emr':
+        bench_emr(args)
+
+
+if __name__ == '__main__':
+    main()
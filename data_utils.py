@@ -1,26 +1,37 @@
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torch.utils.data
 import os
+import json
+import hashlib
+import queue
+import threading
 
 import layers
-from utils import load_wav_to_torch, load_filepaths_and_text
+from mel_cache import MelCache
+from feature_shards import FeatureShard
+from text_store import TextSequenceStore
+from utils import load_wav_norm, load_filepaths_and_text
 # for individual & batch level permuting
-from utils import permute_filelist, permute_batch_from_filelist
+from utils import permute_filelist_idxs, permute_batch_from_filelist
 # for pre-batching
 from utils import batching, get_batch_sizes, permute_batch_from_batch
+from utils import get_memory_batch_sizes, get_attention_batch_sizes
+from utils import get_key_values
+from memory_model import MemoryModel
+from batch_plan import save_plan, load_plan
 from text import text_to_sequence
 
 
-class TextMelLoader(torch.utils.data.Dataset):
+class TextMelBase():
+    """ What TextMelLoader and TextMelStream share: the options, and loading
+    and parsing of filelist lines into (text, mel, ...) samples. Subclasses
+    provide iter_lines, an iterator over the lines of the filelist.
     """
-        1) loads audio,text pairs
-        2) normalizes text and converts them to sequences of one-hot vectors
-        3) computes mel-spectrograms from audio files.
-    """
-    def __init__(self, audiopaths_and_text, shuffle_plan, hparams, epoch=0,
+    def __init__(self, audiopaths_and_text, shuffle_plan, hparams,
                  speaker_ids=None, emotion_ids=None):
-        self.audiopaths_and_text = load_filepaths_and_text(audiopaths_and_text)
+        self.filelist = audiopaths_and_text
         self.shuffle_audiopaths = shuffle_plan['shuffle-audiopath']
         self.shuffle_batches = shuffle_plan['shuffle-batch']
         self.permute_opt = shuffle_plan['permute-opt']
@@ -28,12 +39,15 @@ class TextMelLoader(torch.utils.data.Dataset):
         self.prep_trainset_per_epoch = hparams.prep_trainset_per_epoch
         self.filelist_cols = hparams.filelist_cols
         self.local_rand_factor = hparams.local_rand_factor
+        self.bucket_width = hparams.bucket_width
+        self.text_bucket_width = hparams.text_bucket_width
         self.include_emo_emb = hparams.include_emo_emb
         self.emo_emb_dim = hparams.emo_emb_dim
         self.text_cleaners = hparams.text_cleaners
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
         self.load_mel_from_disk = hparams.load_mel_from_disk
+        self.batch_mel_extraction = hparams.batch_mel_extraction
         self.n_speakers = hparams.n_speakers
         self.n_emotions = hparams.n_emotions
         self.label_type = hparams.label_type
@@ -51,36 +65,57 @@ class TextMelLoader(torch.utils.data.Dataset):
             self.filter_length, self.hop_length, self.win_length,
             hparams.n_mel_channels, hparams.sampling_rate, hparams.mel_fmin,
             hparams.mel_fmax)
-
-        audiopaths_and_text_ori = self.audiopaths_and_text[:]
-        if self.prep_trainset_per_epoch:
-            seed = hparams.seed + epoch
-        else:
-            seed = hparams.seed
-        if self.shuffle_audiopaths:
-            self.audiopaths_and_text = permute_filelist(self.audiopaths_and_text,
-                self.filelist_cols, seed, self.permute_opt, self.local_rand_factor)[0]
-        if self.pre_batching:
-            batch_sizes = get_batch_sizes(self.audiopaths_and_text,
-                                 hparams.filelist_cols, hparams.batch_size)
-            assert sum(batch_sizes) == len(self.audiopaths_and_text),\
-                "check: not all samples get batched in pre-batching!"
-            self.audiopaths_and_text = batching(self.audiopaths_and_text, batch_sizes)
-        if self.shuffle_batches:
-            if self.pre_batching:
-                self.audiopaths_and_text = permute_batch_from_batch(
-                    self.audiopaths_and_text, seed)
-            else:
-                self.audiopaths_and_text = permute_batch_from_filelist(
-                    self.audiopaths_and_text, hparams.batch_size, seed)
+        self.mel_cache = None
+        if hparams.mel_cache_dir and not self.load_mel_from_disk:
+            stft_params = {'filter_length': self.filter_length,
+                'hop_length': self.hop_length, 'win_length': self.win_length,
+                'n_mel_channels': hparams.n_mel_channels,
+                'sampling_rate': hparams.sampling_rate,
+                'mel_fmin': hparams.mel_fmin, 'mel_fmax': hparams.mel_fmax,
+                'max_wav_value': hparams.max_wav_value}
+            self.mel_cache = MelCache(hparams.mel_cache_dir, stft_params)
+        self.feature_shard = None
+        if hparams.feature_shard:
+            self.feature_shard = FeatureShard(hparams.feature_shard)
+        self.text_store = None
+        if hparams.text_store_dir:
+            self.text_store = TextSequenceStore(hparams.text_store_dir,
+                audiopaths_and_text, self.text_cleaners)
+            text_idx = self.filelist_cols.index('text')
+            self.text_store.update(line[text_idx] for line in self.iter_lines())
+
+        self.seed = hparams.seed
+        self.batch_size = hparams.batch_size
+        self.batch_budget = hparams.batch_budget
+        self.batch_policy = hparams.batch_policy
+        self.frames_per_sec = hparams.sampling_rate / self.hop_length
+        self.memory_model = None
+        if hparams.memory_model and hparams.memory_budget > 0:
+            self.memory_model = MemoryModel.load(hparams.memory_model)
+            self.memory_budget = hparams.memory_budget
 
         self.speaker_ids = speaker_ids
         if not self.speaker_ids:
-            self.speaker_ids = self.create_lookup(audiopaths_and_text_ori, 'speaker')
+            self.speaker_ids = self.create_lookup(self.iter_lines(), 'speaker')
 
         self.emotion_ids = emotion_ids
         if not self.emotion_ids:
-            self.emotion_ids = self.create_lookup(audiopaths_and_text_ori, 'emotion')
+            self.emotion_ids = self.create_lookup(self.iter_lines(), 'emotion')
+
+    def get_batch_sizes(self, audiopaths_and_text):
+        """sizes of pre-batches of filelist lines in their order, fitting the
+        memory budget if a memory model is given, else the batch budget (of
+        attention cost if the batch policy is 'attention')"""
+        if self.memory_model is not None:
+            return get_memory_batch_sizes(audiopaths_and_text,
+                self.filelist_cols, self.frames_per_sec, self.memory_model,
+                self.memory_budget)
+        if self.batch_policy == 'attention':
+            return get_attention_batch_sizes(audiopaths_and_text,
+                self.filelist_cols, self.frames_per_sec, self.batch_size,
+                self.batch_budget)
+        return get_batch_sizes(audiopaths_and_text, self.filelist_cols,
+            self.batch_size, self.batch_budget, self.batch_policy)
 
     def parse_filelist_line(self, audiopath_and_text):
         # parse basic cols
@@ -98,32 +133,50 @@ class TextMelLoader(torch.utils.data.Dataset):
             emotion = audiopath_and_text[self.filelist_cols.index('emotion')]
         return audiopath, emoembpath, text, dur, speaker, emotion
 
-    def get_mel_text_pair(self, audiopath_and_text):
+    def get_mel_text_pair(self, audiopath_and_text, mel=None):
         # separate filename and text
         emoemb, speaker, emotion = '', '', ''
         audiopath, emoembpath, text, dur, speaker, emotion = \
             self.parse_filelist_line(audiopath_and_text)
         text = self.get_text(text)  # int_tensor[char_index, ....]
-        mel = self.get_mel(audiopath)  # []
+        if mel is None:
+            mel = self.get_mel(audiopath)  # []
         if self.use_vae:
             if self.include_emo_emb:
                 emoemb = self.get_emoemb(emoembpath)
-            speaker = self.get_speaker(speaker, self.label_type)
-            emotion = self.get_emotion(emotion, self.label_type)
+            speaker = self.get_speaker(speaker)
+            emotion = self.get_emotion(emotion)
         audioid = os.path.splitext(os.path.basename(audiopath))[0]
         return (text, mel, emoemb, speaker, emotion, dur, audioid)
 
+    def get_mel_text_pairs(self, audiopaths_and_text):
+        audiopaths = [self.parse_filelist_line(audiopath_and_text)[0] for
+                      audiopath_and_text in audiopaths_and_text]
+        mels = self.get_mels(audiopaths)
+        pairs = [self.get_mel_text_pair(audiopath_and_text, mel) for
+                 audiopath_and_text, mel in zip(audiopaths_and_text, mels)]
+        return pairs
+
     def get_mel(self, filename):
+        if self.feature_shard is not None and \
+            self.feature_shard.has('mel', filename):
+            melspec = self.feature_shard.get('mel', filename)
+            assert melspec.size(0) == self.stft.n_mel_channels, (
+                'Mel dimension mismatch: given {}, expected {}'.format(
+                    melspec.size(0), self.stft.n_mel_channels))
+            return melspec
+        if self.mel_cache is not None:
+            melspec = self.mel_cache.load(filename)
+            if melspec is not None:
+                return melspec
         if not self.load_mel_from_disk:
-            audio, sampling_rate = load_wav_to_torch(filename)
-            if sampling_rate != self.stft.sampling_rate:
-                raise ValueError("{} SR doesn't match target {} SR".format(
-                    sampling_rate, self.stft.sampling_rate))
-            audio_norm = audio / self.max_wav_value
+            audio_norm = self.get_audio(filename)
             audio_norm = audio_norm.unsqueeze(0)
             audio_norm = torch.autograd.Variable(audio_norm, requires_grad=False)
             melspec = self.stft.mel_spectrogram(audio_norm) # 1 X n_mel_channels X n_frames
             melspec = torch.squeeze(melspec, 0) # n_mel_channels X n_frames
+            if self.mel_cache is not None:
+                self.mel_cache.save(filename, melspec)
         else:
             melspec = torch.from_numpy(np.load(filename))
             assert melspec.size(0) == self.stft.n_mel_channels, (
@@ -132,14 +185,47 @@ class TextMelLoader(torch.utils.data.Dataset):
 
         return melspec
 
+    def get_mels(self, filenames):
+        """get mels of a pre-batch, extracting the uncached ones in one pass"""
+        if self.load_mel_from_disk or self.feature_shard is not None or \
+            not self.batch_mel_extraction:
+            return [self.get_mel(filename) for filename in filenames]
+        if self.mel_cache is not None:
+            mels = [self.mel_cache.load(filename) for filename in filenames]
+        else:
+            mels = [None] * len(filenames)
+        idxs = [i for i, mel in enumerate(mels) if mel is None]
+        if len(idxs) > 0:
+            audios = [self.get_audio(filenames[i]) for i in idxs]
+            for i, melspec in zip(idxs, self.stft.mel_spectrograms(audios)):
+                mels[i] = melspec
+                if self.mel_cache is not None:
+                    self.mel_cache.save(filenames[i], melspec)
+        return mels
+
+    def get_audio(self, filename):
+        audio_norm, sampling_rate = load_wav_norm(filename, self.max_wav_value)
+        if sampling_rate != self.stft.sampling_rate:
+            raise ValueError("{} SR doesn't match target {} SR".format(
+                sampling_rate, self.stft.sampling_rate))
+        return audio_norm
+
     def get_emoemb(self, filename):
-        emoemb = torch.from_numpy(np.load(filename)).T
+        if self.feature_shard is not None and \
+            self.feature_shard.has('emoemb', filename):
+            emoemb = self.feature_shard.get('emoemb', filename).T
+        else:
+            emoemb = torch.from_numpy(np.load(filename)).T
         assert emoemb.size(0) == self.emo_emb_dim, (
             'Emotion embedding dimension mismatch: given {}, expected {}'.format(
                 emoemb.size(0), self.emo_emb_dim))
         return emoemb
 
     def get_text(self, text):
+        if self.text_store is not None:
+            sequence = self.text_store.get(text)
+            if sequence is not None:
+                return torch.from_numpy(sequence)
         text_norm = torch.IntTensor(text_to_sequence(text, self.text_cleaners))
         return text_norm
 
@@ -149,37 +235,338 @@ class TextMelLoader(torch.utils.data.Dataset):
         d = {ids[i]: i for i in range(len(ids))}
         return d
 
-    def get_speaker(self, speaker, label_type='one-hot'):
-        if label_type == 'one-hot':
-            speaker_vector = np.zeros(self.n_speakers)
-            speaker_vector[self.speaker_ids[speaker]] = 1
-            output = torch.Tensor(speaker_vector.astype(dtype=np.float32))
-        elif label_type == 'id':
-            output = torch.tensor([self.speaker_ids[speaker]])
-        return output
-
-    def get_emotion(self, emotion, label_type='one-hot'):
-        if label_type == 'one-hot':
-            emotion_vector = np.zeros(self.n_emotions)
-            emotion_vector[self.emotion_ids[emotion]] = 1
-            output = torch.Tensor(emotion_vector.astype(dtype=np.float32))
-        elif label_type == 'id':
-            output = torch.tensor([self.emotion_ids[emotion]])
-        return output
+    def get_speaker(self, speaker):
+        """id of the speaker, turned into a label by TextMelCollate"""
+        return self.speaker_ids[speaker]
 
-    def __getitem__(self, index):
+    def get_emotion(self, emotion):
+        """id of the emotion, turned into a label by TextMelCollate"""
+        return self.emotion_ids[emotion]
+
+class TextMelLoader(TextMelBase, torch.utils.data.Dataset):
+    """
+        1) loads audio,text pairs
+        2) normalizes text and converts them to sequences of one-hot vectors
+        3) computes mel-spectrograms from audio files.
+    """
+    def __init__(self, audiopaths_and_text, shuffle_plan, hparams,
+                 speaker_ids=None, emotion_ids=None):
+        self.audiopaths_and_text = load_filepaths_and_text(audiopaths_and_text)
+        super(TextMelLoader, self).__init__(audiopaths_and_text, shuffle_plan,
+            hparams, speaker_ids, emotion_ids)
+        # the order of samples is planned per epoch by get_plan, so the
+        # filelist itself always stays in file order
+        self.plan_dir = hparams.plan_dir
+        self.filelist_hash = None
+
+    def iter_lines(self):
+        return iter(self.audiopaths_and_text)
+
+    def get_plan(self, epoch=0):
+        """get sample indices in their order of an epoch, or lists of sample
+        indices (one per pre-batch) if pre-batching. The plan only depends on
+        the seed (and the epoch if prep_trainset_per_epoch)"""
+        if self.prep_trainset_per_epoch:
+            seed = self.seed + epoch
+        else:
+            seed = self.seed
+        if self.plan_dir:
+            plan_path = self.get_plan_path(seed)
+            if os.path.isfile(plan_path):
+                return load_plan(plan_path)
+        idxs = list(range(len(self.audiopaths_and_text)))
+        if self.shuffle_audiopaths:
+            idxs = permute_filelist_idxs(self.audiopaths_and_text,
+                self.filelist_cols, seed, self.permute_opt,
+                self.local_rand_factor, self.bucket_width,
+                self.text_bucket_width)[0].tolist()
         if self.pre_batching:
-            audiopaths_and_text = self.audiopaths_and_text[index]
-            pairs = [self.get_mel_text_pair(audiopath_and_text) for
-                     audiopath_and_text in audiopaths_and_text]
+            audiopaths_and_text = [self.audiopaths_and_text[i] for i in idxs]
+            batch_sizes = self.get_batch_sizes(audiopaths_and_text)
+            assert sum(batch_sizes) == len(idxs),\
+                "check: not all samples get batched in pre-batching!"
+            idxs = batching(idxs, batch_sizes)
+        if self.shuffle_batches:
+            if self.pre_batching:
+                idxs = permute_batch_from_batch(idxs, seed)
+            else:
+                idxs = permute_batch_from_filelist(idxs, self.batch_size, seed)
+        if self.plan_dir:
+            save_plan(plan_path, idxs)
+        return idxs
+
+    def get_batch_areas(self, batches):
+        """batch size x max key value (dur or text length) of batches of
+        sample indices"""
+        key_values = np.array(get_key_values(self.audiopaths_and_text,
+                                             self.filelist_cols)[0], dtype=np.float64)
+        return np.array([len(batch) * key_values[batch].max() for batch in batches])
+
+    def get_plan_path(self, seed):
+        """plan file named after a hash of the filelist content, the seed
+        and every option the plan depends on"""
+        if self.filelist_hash is None:
+            sha1 = hashlib.sha1()
+            with open(self.filelist, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(chunk)
+            self.filelist_hash = sha1.hexdigest()
+        options = {'filelist': self.filelist_hash, 'seed': seed,
+            'shuffle-audiopath': self.shuffle_audiopaths,
+            'shuffle-batch': self.shuffle_batches,
+            'permute-opt': self.permute_opt, 'pre-batching': self.pre_batching,
+            'filelist-cols': self.filelist_cols,
+            'local-rand-factor': self.local_rand_factor,
+            'bucket-width': self.bucket_width,
+            'text-bucket-width': self.text_bucket_width,
+            'batch-size': self.batch_size, 'batch-budget': self.batch_budget,
+            'batch-policy': self.batch_policy,
+            'frames-per-sec': self.frames_per_sec}
+        if self.memory_model is not None:
+            options.update({'memory-model': self.memory_model.coefs.tolist(),
+                'memory-margin': self.memory_model.margin,
+                'memory-budget': self.memory_budget})
+        key = hashlib.sha1(json.dumps(options, sort_keys=True).encode('utf-8'))
+        name = '{}.{}.npz'.format(os.path.basename(self.filelist),
+                                  key.hexdigest()[:16])
+        return os.path.join(self.plan_dir, name)
+
+    def __getitem__(self, index):
+        if isinstance(index, (list, tuple)):
+            # pre-batch of sample indices
+            audiopaths_and_text = [self.audiopaths_and_text[i] for i in index]
+            pairs = self.get_mel_text_pairs(audiopaths_and_text)
         else:
             pairs = self.get_mel_text_pair(self.audiopaths_and_text[index])
         return pairs
 
+    def __getitems__(self, indices):
+        # used by DataLoader (torch >= 2.0) to fetch a batch from a batch
+        # sampler in one call, so the mels of the batch are extracted together
+        return self[list(indices)]
+
     def __len__(self):
         return len(self.audiopaths_and_text)
 
 
+class TextMelStream(TextMelBase, torch.utils.data.IterableDataset):
+    """ Streaming variant of TextMelLoader for corpora too large to keep the
+    filelist in memory.
+
+    Filelist lines are read lazily and split over ranks and DataLoader
+    workers by line number. Each shard is shuffled approximately through a
+    buffer of hparams.stream_buffer_size lines: if pre-batching, a full
+    buffer is semi-sorted (or bucketed if permute_opt is 'bucket') by key,
+    cut into batches of similar lengths with get_batch_sizes, and the
+    batches are yielded in random order. Memory use is
+    bounded by the buffer size, whatever the size of the corpus.
+
+    The shuffle seed advances by one per pass (or is set by set_epoch), so
+    persistent workers, whose copies of the dataset cannot be reached from
+    the main process, stay in step with the epochs.
+
+    The shards of the ranks differ in #batches; count_batches gives those
+    of this rank for the current epoch, so distributed runs can agree on
+    the #steps of the epoch.
+    """
+    def __init__(self, audiopaths_and_text, shuffle_plan, hparams, epoch=0,
+                 num_replicas=1, rank=0, speaker_ids=None, emotion_ids=None):
+        self.buffer_size = hparams.stream_buffer_size
+        self.epoch = epoch
+        self.num_replicas = num_replicas
+        self.rank = rank
+        super(TextMelStream, self).__init__(audiopaths_and_text, shuffle_plan,
+            hparams, speaker_ids, emotion_ids)
+
+    def iter_lines(self, split='|'):
+        with open(self.filelist, encoding='utf-8') as f:
+            for line in f:
+                yield line.strip().split(split)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_rng(self, shard):
+        """random state of a shard in the current epoch"""
+        if self.prep_trainset_per_epoch:
+            seed = self.seed + self.epoch
+        else:
+            seed = self.seed
+        return np.random.RandomState([seed, shard])
+
+    def iter_buffers(self, shards, num_shards):
+        """yield (shard, buffer) pairs of the full buffers of filelist lines
+        of shards as they fill up, then of the last partial ones"""
+        buffers = {shard: [] for shard in shards}
+        for i, audiopath_and_text in enumerate(self.iter_lines()):
+            shard = i % num_shards
+            if shard not in buffers:
+                continue
+            buffers[shard].append(audiopath_and_text)
+            if len(buffers[shard]) == self.buffer_size:
+                yield shard, buffers[shard]
+                buffers[shard] = []
+        for shard in shards:
+            if len(buffers[shard]) > 0:
+                yield shard, buffers[shard]
+
+    def plan_buffer(self, buffer, rng):
+        """filelist lines of a buffer in random order, or length-bucketed
+        batches of them in random order if pre-batching"""
+        if not self.pre_batching:
+            return [buffer[i] for i in rng.permutation(len(buffer))]
+        # buckets, or a (semi-)sort, so the batches are of similar lengths
+        if self.permute_opt in ['bucket', 'bucket-2d']:
+            permute_opt = self.permute_opt
+        else:
+            permute_opt = 'semi-sort'
+        local_rand_factor = self.local_rand_factor if self.shuffle_audiopaths else 0
+        idxs = permute_filelist_idxs(buffer, self.filelist_cols,
+            rng.randint(2**31), permute_opt, local_rand_factor,
+            self.bucket_width, self.text_bucket_width)[0]
+        buffer = [buffer[i] for i in idxs]
+        batch_sizes = self.get_batch_sizes(buffer)
+        batches = batching(buffer, batch_sizes)
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def count_batches(self, num_workers=0):
+        """#batches of this rank in the current epoch through a DataLoader
+        with num_workers workers (which batch by batch_size, dropping the
+        last partial batch of every worker, if not pre-batching). The plan
+        is dry-run without loading any audio or mel"""
+        num_workers = max(1, num_workers)
+        num_shards = self.num_replicas * num_workers
+        shards = [self.rank * num_workers + w for w in range(num_workers)]
+        rngs = {shard: self.get_rng(shard) for shard in shards}
+        n_items = {shard: 0 for shard in shards}
+        for shard, buffer in self.iter_buffers(shards, num_shards):
+            n_items[shard] += len(self.plan_buffer(buffer, rngs[shard]))
+        if self.pre_batching:
+            return sum(n_items.values())
+        return sum(n // self.batch_size for n in n_items.values())
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            num_workers, worker_id = 1, 0
+        else:
+            num_workers, worker_id = worker_info.num_workers, worker_info.id
+        num_shards = self.num_replicas * num_workers
+        shard = self.rank * num_workers + worker_id
+        rng = self.get_rng(shard)
+        self.epoch += 1
+
+        for _, buffer in self.iter_buffers([shard], num_shards):
+            for item in self.plan_buffer(buffer, rng):
+                if self.pre_batching:
+                    yield self.get_mel_text_pairs(item)
+                else:
+                    yield self.get_mel_text_pair(item)
+
+
+class TextMelSampler(torch.utils.data.Sampler):
+    """ Yields the plan of a TextMelLoader for the current epoch, i.e. sample
+    indices, or lists of sample indices (one per pre-batch) if pre-batching.
+
+    The plan is recomputed from the seed by set_epoch in the main process, so
+    the dataset, the DataLoader and its workers can live across epochs. With
+    num_replicas > 1 every rank gets an equally long, disjoint part of it.
+    """
+    def __init__(self, dataset, epoch=0, shuffle=False, num_replicas=1, rank=0,
+                 balanced=False):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.balanced = balanced and dataset.pre_batching and num_replicas > 1
+        self.epoch = None
+        self.set_epoch(epoch)
+
+    def set_epoch(self, epoch, start=0):
+        """plan of the epoch, from its item start on (e.g. to resume an epoch
+        without iterating through its first items)"""
+        reseeded = self.dataset.prep_trainset_per_epoch or self.shuffle
+        if self.epoch is None or reseeded:
+            plan = self.dataset.get_plan(epoch)
+            if self.shuffle:
+                rng = np.random.RandomState(self.dataset.seed + epoch)
+                plan = [plan[i] for i in rng.permutation(len(plan))]
+            if self.num_replicas > 1:
+                # pad with the first items so every rank gets the same length
+                total_size = int(np.ceil(len(plan) / self.num_replicas)) * self.num_replicas
+                plan = plan + plan[:total_size-len(plan)]
+                if self.balanced:
+                    plan = self.balance_steps(plan, epoch)
+                plan = plan[self.rank:total_size:self.num_replicas]
+            self.epoch_plan = plan
+        # otherwise the plan does not change across epochs
+        self.epoch = epoch
+        self.plan = self.epoch_plan[start:]
+
+    def balance_steps(self, plan, epoch):
+        """order pre-batches so the num_replicas batches of each step (one
+        per rank) have similar areas: batches sorted by area are grouped
+        into steps, which keep the order of their first batch in the plan,
+        and are dealt to the ranks in random order. The order is the same
+        on all ranks."""
+        areas = self.dataset.get_batch_areas(plan)
+        order = np.argsort(areas, kind='stable').reshape(-1, self.num_replicas)
+        order = order[np.argsort(order.min(axis=1))]
+        rng = np.random.RandomState(self.dataset.seed + epoch)
+        order = np.take_along_axis(order,
+            np.argsort(rng.rand(*order.shape), axis=1), axis=1)
+        return [plan[i] for i in order.ravel()]
+
+    def __iter__(self):
+        return iter(self.plan)
+
+    def __len__(self):
+        return len(self.plan)
+
+
+class FrameBudgetBatchSampler(torch.utils.data.BatchSampler):
+    """ Yields batches of sample indices of a TextMelLoader whose samples fit
+    a frame (or duration) budget.
+
+    Samples are permuted as set in the dataset's shuffle plan and grouped by
+    utils.get_batch_sizes (policy hparams.batch_policy) with a budget of
+    hparams.batch_budget, or of batch_size x mean of the batch_size longest
+    samples if it is 0. Batches are then reshuffled and sharded by rank per
+    epoch as in TextMelSampler.
+    """
+    def __init__(self, dataset, epoch=0, shuffle=False, num_replicas=1, rank=0,
+                 balanced=False):
+        assert dataset.pre_batching, "batches are planned only if pre-batching"
+        # there is no sampler to wrap, the batches are planned by the dataset
+        self.batch_size = dataset.batch_size
+        self.drop_last = False
+        self.sampler = TextMelSampler(dataset, epoch, shuffle, num_replicas, rank,
+                                      balanced)
+
+    def set_epoch(self, epoch, start=0):
+        self.sampler.set_epoch(epoch, start)
+
+    def __iter__(self):
+        return iter(self.sampler)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+LABEL_TYPES = ['one-hot', 'id']
+
+
+def get_labels(ids, n_labels, label_type='one-hot'):
+    """one-hot vectors (batch size X n_labels) or ids of a batch of label ids,
+    built per batch, so memory does not grow with n_labels squared"""
+    ids = torch.LongTensor(ids)
+    if label_type == 'one-hot':
+        return F.one_hot(ids, n_labels)
+    elif label_type == 'id':
+        return ids
+    raise ValueError('unknown label type {}'.format(label_type))
+
+
 class TextMelCollate():
     """ Zero-pads model inputs and targets based on number of frames per step
     """
@@ -188,6 +575,11 @@ class TextMelCollate():
         self.n_frames_per_step = hparams.n_frames_per_step
         self.label_type = hparams.label_type
         self.use_vae = hparams.use_vae
+        # samples carry label ids, turned into labels per batch
+        self.n_speakers = hparams.n_speakers
+        self.n_emotions = hparams.n_emotions
+        if self.use_vae and self.label_type not in LABEL_TYPES:
+            raise ValueError('unknown label type {}'.format(self.label_type))
 
     def __call__(self, batch):
         """Collate's training batch from normalized text and mel-spectrogram
@@ -202,52 +594,35 @@ class TextMelCollate():
         if self.pre_batching:
             batch = batch[0]
 
-        # Right zero-pad all one-hot text sequences to max input length
+        # sort once by text length, then every field is filled in this order
         input_lengths, ids_sorted_decreasing = torch.sort(
             torch.LongTensor([len(x[0]) for x in batch]),
             dim=0, descending=True)
-        max_input_len = input_lengths[0]
+        batch = [batch[i] for i in ids_sorted_decreasing.tolist()]
+        batch_size = len(batch)
+        max_input_len = int(input_lengths[0])
 
-        text_padded = torch.LongTensor(len(batch), max_input_len)
-        text_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            text = batch[ids_sorted_decreasing[i]][0]
-            text_padded[i, :text.size(0)] = text
+        # Right zero-pad all one-hot text sequences to max input length, the
+        # concatenated sequences are scattered into the valid positions
+        text_padded = torch.zeros(batch_size, max_input_len, dtype=torch.long)
+        text_mask = torch.arange(max_input_len) < input_lengths.unsqueeze(1)
+        text_padded[text_mask] = torch.cat([x[0] for x in batch]).long()
 
         if self.use_vae:
-            if self.label_type == 'one-hot':
-                speakers = torch.LongTensor(len(batch), len(batch[0][3]))
-                for i in range(len(ids_sorted_decreasing)):
-                    speaker = batch[ids_sorted_decreasing[i]][3]
-                    speakers[i, :] = speaker
-                emotions = torch.LongTensor(len(batch), len(batch[0][4]))
-                for i in range(len(ids_sorted_decreasing)):
-                    emotion = batch[ids_sorted_decreasing[i]][4]
-                    emotions[i, :] = emotion
-            elif self.label_type == 'id':
-                speakers = torch.LongTensor(len(batch))
-                emotions = torch.LongTensor(len(batch))
-                for i in range(len(ids_sorted_decreasing)):
-                    speakers[i] = batch[ids_sorted_decreasing[i]][3]
-                    emotions[i] = batch[ids_sorted_decreasing[i]][4]
+            speakers = get_labels([x[3] for x in batch], self.n_speakers,
+                                  self.label_type)
+            emotions = get_labels([x[4] for x in batch], self.n_emotions,
+                                  self.label_type)
         else:
             speakers = emotions = ''
 
-        durs = [[] for _ in range(len(batch))]
-        audioids = [[] for _ in range(len(batch))]
-        for i in range(len(ids_sorted_decreasing)):
-            durs[i] = batch[ids_sorted_decreasing[i]][5]
-            audioids[i] = batch[ids_sorted_decreasing[i]][6]
+        durs = [x[5] for x in batch]
+        audioids = [x[6] for x in batch]
 
         # Right zero-pad mel-spec
         num_mels = batch[0][1].size(0)
-        max_target_len1 = max([x[1].size(1) for x in batch])
-
-        if len(batch[0][2]) > 0:
-          num_emoembs = batch[0][2].size(0)
-          max_target_len2 = max([x[2].size(1) for x in batch])
-
-        max_target_len = max_target_len1
+        output_lengths = torch.LongTensor([x[1].size(1) for x in batch])
+        max_target_len = int(output_lengths.max())
         # todo: uniform wintime/hoptime of mel and emoemb so max_target_len will be the same
 
         # increment max_target_len to the multiples of n_frames_per_step
@@ -256,27 +631,111 @@ class TextMelCollate():
             assert max_target_len % self.n_frames_per_step == 0
             # todo: to support n_frames_per_step > 1
 
-        # include mel padded and gate padded
-        mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
-        mel_padded.zero_()
-        gate_padded = torch.FloatTensor(len(batch), max_target_len)
-        gate_padded.zero_()
-        output_lengths = torch.LongTensor(len(batch))
-        for i in range(len(ids_sorted_decreasing)):
-            mel = batch[ids_sorted_decreasing[i]][1]
-            mel_padded[i, :, :mel.size(1)] = mel
-            gate_padded[i, mel.size(1)-1:] = 1
-            output_lengths[i] = mel.size(1)
+        # include mel padded and gate padded. Mel (and emoemb) rows are
+        # copied with one slice copy each, which is bandwidth bound: a masked
+        # scatter needs the frames concatenated first, and was 5-9x slower
+        mel_padded = torch.zeros(batch_size, num_mels, max_target_len)
+        for mel_row, x in zip(mel_padded, batch):
+            mel_row[:, :x[1].size(1)] = x[1]
+        gate_padded = (torch.arange(max_target_len) >=
+                       (output_lengths - 1).unsqueeze(1)).float()
 
         if len(batch[0][2]) > 0:
-            emoemb_padded = torch.FloatTensor(len(batch), num_emoembs, max_target_len)
-            emoemb_padded.zero_()
-            for i in range(len(ids_sorted_decreasing)):
-                emoemb = batch[ids_sorted_decreasing[i]][2]
-                emoemb_nframes = min(emoemb.size(1), max_target_len)
-                emoemb_padded[i, :, :emoemb_nframes] = emoemb[:, :emoemb_nframes]
+            num_emoembs = batch[0][2].size(0)
+            emoemb_padded = torch.zeros(batch_size, num_emoembs, max_target_len)
+            for emoemb_row, x in zip(emoemb_padded, batch):
+                emoemb = x[2][:, :max_target_len]
+                emoemb_row[:, :emoemb.size(1)] = emoemb
         else:
             emoemb_padded = ''
 
         return text_padded, input_lengths, mel_padded, emoemb_padded, \
             gate_padded, output_lengths, speakers, emotions, durs, audioids
+
+
+class BatchPrefetcher():
+    """ Iterates a DataLoader in a background thread and stages up to
+    n_prefetch batches ahead of the train loop.
+
+    With CUDA, tensors of a batch are pinned (unless already pinned) and
+    copied to the device on a side stream, so the batches handed out are
+    already on the device and the copies overlap with compute. Without CUDA
+    it still gives multi-batch read-ahead. h2d_time is the time (s) the
+    copies of the last batch handed out took, timed with CUDA events on the
+    side stream (0 without CUDA).
+    """
+    def __init__(self, loader, n_prefetch=2, device=None):
+        self.loader = loader
+        self.n_prefetch = n_prefetch
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda'
+        self.h2d_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, x):
+        if not isinstance(x, torch.Tensor):
+            return x
+        if not x.is_pinned():
+            x = x.pin_memory()
+        return x.to(self.device, non_blocking=True)
+
+    def put(self, staged, item, stop):
+        while not stop.is_set():
+            try:
+                staged.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stage(self, staged, stop):
+        try:
+            stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+            for batch in self.loader:
+                h2d_time = 0.0
+                if self.use_cuda:
+                    with torch.cuda.device(self.device), torch.cuda.stream(stream):
+                        start = torch.cuda.Event(enable_timing=True)
+                        end = torch.cuda.Event(enable_timing=True)
+                        start.record(stream)
+                        batch = tuple(self.to_device(x) for x in batch)
+                        end.record(stream)
+                    # wait here (in the background) until the copies are done,
+                    # so the host buffers of the batch can be reused
+                    stream.synchronize()
+                    h2d_time = start.elapsed_time(end) / 1000
+                if not self.put(staged, (batch, h2d_time), stop):
+                    return
+        except Exception as e:
+            self.put(staged, e, stop)
+            return
+        self.put(staged, None, stop)
+
+    def __iter__(self):
+        staged = queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.stage, args=(staged, stop),
+                                  daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = staged.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                batch, self.h2d_time = batch
+                if self.use_cuda:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    for x in batch:
+                        if isinstance(x, torch.Tensor):
+                            x.record_stream(current_stream)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
@@ -0,0 +1,263 @@
+# Offline mel extraction shared by the dataset preprocessors.
+#
+# Every worker process builds the STFT (Fourier basis, inverse and mel
+# filters) once in its initializer, then gets chunks of utterances of similar
+# file sizes and extracts their mels in zero-padded batches of similar
+# lengths, one STFT pass and one mel matmul per batch (see
+# layers.TacotronSTFT.mel_spectrograms). The results keep the input order.
+#
+# A manifest in the output directory records per utterance:
+#
+#   wav path|size|mtime (ns)|mel path|#frames|hparams hash
+#
+# so re-runs only extract the mels of new or changed wavs (or all of them if
+# the mel hparams changed), and get the #frames of the others from the
+# manifest, without reading their mels. While running, the entries of the
+# chunks are appended to a journal (manifest path + '.journal') as they
+# complete, so an interrupted run resumes where it stopped; the journal is
+# merged into the manifest at the end.
+#
+# The utterances can be split into n shards processed by separate jobs
+# (preprocess.py --shard i/n), by a hash of their id (wav file name without
+# extension). Each shard has its own manifest and mels.txt fragment, which
+# preprocess.py --merge n combines.
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import time
+import numpy as np
+import torch
+import os
+import pickle as pkl
+
+from utils import load_wav_norm, load_filepaths_and_text
+import layers
+
+PARAMS = ['filter_length', 'hop_length', 'win_length', 'n_mel_channels',
+          'sampling_rate', 'mel_fmin', 'mel_fmax', 'max_wav_value',
+          'mel_data_type']
+
+_stft = None
+_params = None
+
+
+def get_params(hparams):
+  '''the hparams of the mel extraction, sent to the worker processes'''
+  return {k: getattr(hparams, k) for k in PARAMS}
+
+
+def get_shard(wav_path, n_shards):
+  '''shard of an utterance, the same on every machine'''
+  utt_id = os.path.splitext(os.path.basename(wav_path))[0]
+  return int(hashlib.sha1(utt_id.encode()).hexdigest()[:8], 16) % n_shards
+
+
+def get_shard_name(name, shard=None):
+  '''file name of shard (i, n) of a file, e.g. mels.shard-0-of-4.txt'''
+  if shard is None:
+    return name
+  base, ext = os.path.splitext(name)
+  return '{}.shard-{}-of-{}{}'.format(base, shard[0], shard[1], ext)
+
+
+def get_params_hash(params):
+  return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def load_manifest(path):
+  '''manifest entries by wav path, empty if there is no manifest'''
+  if not os.path.isfile(path):
+    return {}
+  # the last line of a journal may be cut by a crash
+  return {entry[0]: entry for entry in load_filepaths_and_text(path)
+          if len(entry) == 6}
+
+
+def write_entries(f, entries):
+  for entry in entries:
+    f.write('|'.join([str(x) for x in entry]) + '\n')
+
+
+def save_manifest(path, entries):
+  path_tmp = '{}.{}.tmp'.format(path, os.getpid())
+  with open(path_tmp, 'w', encoding='utf-8') as f:
+    write_entries(f, entries)
+  os.replace(path_tmp, path)
+
+
+def get_entry(wav_path, mel_path, n_frames, params_hash):
+  stat = os.stat(wav_path)
+  return [wav_path, str(stat.st_size), str(stat.st_mtime_ns), mel_path,
+          str(n_frames), params_hash]
+
+
+def is_current(entry, wav_path, params_hash):
+  '''whether a manifest entry is the mel of the current wav_path, with the
+  current hparams'''
+  stat = os.stat(wav_path)
+  return (entry[1] == str(stat.st_size) and entry[2] == str(stat.st_mtime_ns)
+          and entry[5] == params_hash and os.path.isfile(entry[3]))
+
+
+def init_worker(params):
+  '''build the STFT of a worker process once'''
+  global _stft, _params
+  # the processes are the parallelism, avoid oversubscribing the cores
+  torch.set_num_threads(1)
+  _params = params
+  _stft = layers.TacotronSTFT(
+    params['filter_length'], params['hop_length'], params['win_length'],
+    params['n_mel_channels'], params['sampling_rate'], params['mel_fmin'],
+    params['mel_fmax'])
+
+
+def get_mel_path(path):
+  '''the mel path of path without extension for the mel data type'''
+  ext = {'numpy': '.npy', 'torch': '.pt'}[_params['mel_data_type']]
+  return path + ext
+
+
+def get_n_frames(mel_path):
+  '''#frames of an existing mel, None if it has not been generated'''
+  if not os.path.isfile(mel_path):
+    return None
+  if _params['mel_data_type'] == 'numpy':
+    return np.load(mel_path, mmap_mode='r').shape[1]
+  with open(mel_path, 'rb') as f:
+    return pkl.load(f).shape[1]
+
+
+def save_mel(mel_path, melspec):
+  if _params['mel_data_type'] == 'numpy':
+    np.save(mel_path, melspec.numpy(), allow_pickle=False)
+  elif _params['mel_data_type'] == 'torch':
+    # clone, the mel is a view of the whole padded batch
+    with open(mel_path, 'wb') as f:
+      pkl.dump(melspec.clone(), f, protocol=pkl.HIGHEST_PROTOCOL)
+
+
+def group_by_length(idxs, lengths, max_samples):
+  '''split idxs sorted by increasing length into batches whose padded size
+  (batch size x longest length) fits max_samples'''
+  batches, batch = [], []
+  for i in idxs:
+    if batch and (len(batch) + 1) * lengths[i] > max_samples:
+      batches.append(batch)
+      batch = []
+    batch.append(i)
+  if batch:
+    batches.append(batch)
+  return batches
+
+
+def process_chunk(items, max_samples, reuse):
+  '''extract the mels of a chunk of utterances
+    Args:
+      items: (wav_path, mel_path, text) tuples, mel_path without extension
+      max_samples: max #samples of a padded batch of waves
+      reuse: per item, whether an existing mel (not in the manifest) is kept
+    Returns:
+      a (mel_path, n_frames, text) tuple per item
+  '''
+  results = [None] * len(items)
+  audios = {}
+  for i, (wav_path, mel_path, text) in enumerate(items):
+    mel_path = get_mel_path(mel_path)
+    n_frames = get_n_frames(mel_path) if reuse[i] else None
+    if n_frames is not None:
+      results[i] = (mel_path, n_frames, text)
+      continue
+    audio_norm, sampling_rate = load_wav_norm(wav_path, _params['max_wav_value'])
+    if sampling_rate != _params['sampling_rate']:
+      raise ValueError("{}: {} SR doesn't match target {} SR".format(
+        wav_path, sampling_rate, _params['sampling_rate']))
+    audios[i] = audio_norm
+
+  lengths = {i: len(audio) for i, audio in audios.items()}
+  idxs = sorted(audios, key=lengths.get)
+  for batch in group_by_length(idxs, lengths, max_samples):
+    with torch.no_grad():
+      melspecs = _stft.mel_spectrograms([audios[i] for i in batch])
+    for i, melspec in zip(batch, melspecs):
+      mel_path, text = get_mel_path(items[i][1]), items[i][2]
+      save_mel(mel_path, melspec)
+      results[i] = (mel_path, melspec.shape[1], text)
+  return results
+
+
+def build(items, hparams, out_dir, num_workers=1, tqdm=lambda x: x,
+          shard=None, chunk_size=64, max_samples=2**22, report_interval=10):
+  '''extract the mels of items ((wav_path, mel_path, text) tuples, mel_path
+  without extension) in a pool of num_workers processes, except those which
+  are current in the manifest of out_dir, which is then updated. With shard
+  (i, n), only the items of shard i are processed, with their own manifest.
+  The throughput is reported every report_interval seconds.
+    Returns:
+      A list of (mel_path, n_frames, text) tuples in the order of items
+  '''
+  if shard is not None:
+    items = [item for item in items if get_shard(item[0], shard[1]) == shard[0]]
+    print('shard {}/{}: {} utterances'.format(shard[0], shard[1], len(items)))
+  manifest_path = os.path.join(out_dir, get_shard_name('manifest.txt', shard))
+  params = get_params(hparams)
+  params_hash = get_params_hash(params)
+  journal_path = manifest_path + '.journal'
+  manifest = load_manifest(manifest_path)
+  journal = load_manifest(journal_path)
+  if journal:
+    print('resuming from {} entries in {}'.format(len(journal), journal_path))
+    manifest.update(journal)
+    # drop a cut last line before appending to the journal
+    save_manifest(journal_path, journal.values())
+  results = [None] * len(items)
+  entries = [None] * len(items)
+  todo = []
+  for i, (wav_path, _, text) in enumerate(items):
+    entry = manifest.get(wav_path)
+    if entry is not None and is_current(entry, wav_path, params_hash):
+      results[i] = (entry[3], int(entry[4]), text)
+      entries[i] = entry
+    else:
+      todo.append(i)
+  print('{}/{} utterances up to date in {}'.format(
+    len(items) - len(todo), len(items), manifest_path))
+
+  # chunks of similar file sizes, so the batches in a chunk are little padded
+  order = sorted(todo, key=lambda i: os.path.getsize(items[i][0]))
+  chunks = [order[i:i+chunk_size] for i in range(0, len(order), chunk_size)]
+  with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker,
+                           initargs=(params,)) as executor:
+    # existing mels of wavs missing from the manifest are kept, e.g. from a
+    # run before the manifest, stale ones are extracted again
+    futures = [executor.submit(process_chunk, [items[i] for i in chunk],
+                               max_samples, [items[i][0] not in manifest
+                                             for i in chunk])
+               for chunk in chunks]
+    print('{} chunks of {} utterances submitted!'.format(len(chunks), chunk_size))
+    chunk_of = dict(zip(futures, chunks))
+    start, n_done, n_frames = time.perf_counter(), 0, 0
+    reported = start
+    with open(journal_path, 'a', encoding='utf-8') as journal:
+      for future in tqdm(as_completed(futures)):
+        chunk = chunk_of.pop(future)
+        for i, result in zip(chunk, future.result()):
+          results[i] = result
+          entries[i] = get_entry(items[i][0], result[0], result[1], params_hash)
+          n_frames += result[1]
+        write_entries(journal, [entries[i] for i in chunk])
+        journal.flush()
+        os.fsync(journal.fileno())
+        n_done += len(chunk)
+        now = time.perf_counter()
+        if now - reported < report_interval and n_done < len(todo):
+          continue
+        reported, elapsed = now, now - start
+        hours = n_frames * params['hop_length'] / params['sampling_rate'] / 3600
+        print('{}/{} utterances, {:.1f} utt/s, {:.3f} audio-hours/s'.format(
+          n_done, len(todo), n_done / elapsed, hours / elapsed))
+
+  save_manifest(manifest_path, entries)
+  if os.path.isfile(journal_path):
+    os.remove(journal_path)
+  return results
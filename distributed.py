@@ -134,9 +134,14 @@ def apply_gradient_allreduce(module):
                 continue
             dist.broadcast(p, 0)
 
+        # called without arguments before the gradients are allreduced
+        module.allreduce_pre_hooks = []
+
         def allreduce_params():
             if(module.needs_reduction):
                 module.needs_reduction = False
+                for hook in module.allreduce_pre_hooks:
+                    hook()
                 buckets = {}
                 for param in module.parameters():
                     if param.requires_grad and param.grad is not None:
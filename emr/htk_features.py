@@ -0,0 +1,173 @@
+# In-process HTK filterbank features: a numpy port of what HCopy computes from
+# a wav file for the configuration in htk.cfg (TARGETKIND FBANK with the _E,
+# _D and _A qualifiers), so features need neither the HTK binaries nor
+# temporary .htk files. The frames of many utterances are processed together,
+# with one FFT and one filterbank matmul for all of them.
+#
+# Per frame, as in HTK's HParm/HSigP: zero mean (ZMEANSOURCE), raw energy
+# (RAWENERGY), pre-emphasis (PREEMCOEF), Hamming window (USEHAMMING), power
+# (USEPOWER) or magnitude spectrum, triangular mel filters between LOFREQ and
+# HIFREQ, log with a floor of 1. Per utterance: energy normalisation
+# (ENORMALISE, ESCALE, SILFLOOR) and regression deltas and accelerations
+# (DELTAWINDOW, ACCWINDOW) with replicated edge frames.
+
+import numpy as np
+
+LZERO = -1.0E10 # HTK's log of zero
+MINLARG = 2.45E-308 # smallest argument of log in HTK
+
+
+def read_config(cfg_file):
+    """HTK config file as a dict of upper-case parameter names to values"""
+    cfg = {}
+    with open(cfg_file) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if '=' not in line:
+                continue
+            name, value = [s.strip() for s in line.split('=', 1)]
+            # drop module prefixes, e.g. HSHELL: MAXTRYOPEN
+            cfg[name.split(':')[-1].strip().upper()] = value
+    return cfg
+
+
+def parse_bool(value):
+    return value.upper() in ['T', 'TRUE']
+
+
+def mel(f):
+    return 1127 * np.log(1 + f / 700.0)
+
+
+def get_fbank(fft_size, sampling_rate, num_chans, lo_freq=-1.0, hi_freq=-1.0):
+    """weights of HTK's mel filters, #fft bins X num_chans"""
+    n_by_2 = fft_size // 2
+    fres = sampling_rate / (fft_size * 700.0)
+    klo, khi = 2, n_by_2
+    mlo, mhi = 0.0, 1127 * np.log(1 + n_by_2 * fres)
+    if lo_freq >= 0:
+        mlo = mel(lo_freq)
+        klo = max(2, int(lo_freq * fft_size / sampling_rate + 2.5))
+    if hi_freq >= 0:
+        mhi = mel(hi_freq)
+        khi = min(n_by_2, int(hi_freq * fft_size / sampling_rate + 0.5))
+    # centres of the filters 1 .. num_chans, the filter edges are centres 0
+    # and num_chans + 1
+    centres = np.arange(num_chans + 2) / (num_chans + 1.0) * (mhi - mlo) + mlo
+    centres[0] = mlo
+    weights = np.zeros((n_by_2 + 1, num_chans))
+    for k in range(klo, khi + 1):
+        # HTK bins are 1-based, bin k has frequency (k - 1) * sr / fft_size
+        melk = 1127 * np.log(1 + (k - 1) * fres)
+        chan = int(np.searchsorted(centres[1:], melk)) + 1 # first centre >= melk
+        if chan > num_chans + 1:
+            continue
+        lo_chan = chan - 1
+        lo_wt = (centres[chan] - melk) / (centres[chan] - centres[lo_chan])
+        if lo_chan > 0:
+            weights[k - 1, lo_chan - 1] += lo_wt
+        if lo_chan < num_chans:
+            weights[k - 1, lo_chan] += 1 - lo_wt
+    return weights
+
+
+def add_regression(x, window):
+    """HTK regression coefficients of x (#frames X dim) over +-window frames,
+    the first and last frames are replicated at the edges"""
+    n = len(x)
+    padded = np.concatenate([np.repeat(x[:1], window, axis=0), x,
+                             np.repeat(x[-1:], window, axis=0)])
+    d = sum(t * (padded[window+t:window+t+n] - padded[window-t:window-t+n])
+            for t in range(1, window + 1))
+    return d / (2.0 * sum(t * t for t in range(1, window + 1)))
+
+
+class HTKFeatures():
+    """FBANK features of waves as HCopy computes them with an HTK config"""
+    def __init__(self, cfg, sampling_rate):
+        kind = cfg.get('TARGETKIND', 'FBANK').upper().split('_')
+        assert kind[0] == 'FBANK' and set(kind[1:]) <= set('EDA'), (
+            'TARGETKIND {} is not supported'.format(cfg.get('TARGETKIND')))
+        self.use_energy = 'E' in kind
+        self.use_delta = 'D' in kind
+        self.use_accel = 'A' in kind
+        samp_period = 1E7 / sampling_rate # in 100 ns units, as in HTK
+        self.frame_size = int(float(cfg['WINDOWSIZE']) / samp_period + 1E-6)
+        self.frame_shift = int(float(cfg['TARGETRATE']) / samp_period + 1E-6)
+        self.fft_size = 2 ** int(np.ceil(np.log2(self.frame_size)))
+        self.zero_mean = parse_bool(cfg.get('ZMEANSOURCE', 'F'))
+        self.pre_emph = float(cfg.get('PREEMCOEF', 0.97))
+        self.use_power = parse_bool(cfg.get('USEPOWER', 'F'))
+        self.raw_energy = parse_bool(cfg.get('RAWENERGY', 'T'))
+        self.e_normalise = parse_bool(cfg.get('ENORMALISE', 'T'))
+        self.e_scale = float(cfg.get('ESCALE', 0.1))
+        self.sil_floor = float(cfg.get('SILFLOOR', 50.0))
+        self.delta_window = int(cfg.get('DELTAWINDOW', 2))
+        self.accel_window = int(cfg.get('ACCWINDOW', 2))
+        self.window = np.ones(self.frame_size)
+        if parse_bool(cfg.get('USEHAMMING', 'T')):
+            i = np.arange(self.frame_size)
+            self.window = 0.54 - 0.46 * np.cos(2 * np.pi * i / (self.frame_size - 1))
+        self.fbank = get_fbank(self.fft_size, sampling_rate,
+                               int(cfg.get('NUMCHANS', 20)),
+                               float(cfg.get('LOFREQ', -1.0)),
+                               float(cfg.get('HIFREQ', -1.0)))
+
+    def n_frames(self, n_samples):
+        if n_samples < self.frame_size:
+            return 0
+        return (n_samples - self.frame_size) // self.frame_shift + 1
+
+    def frames(self, wave):
+        n_frames = self.n_frames(len(wave))
+        if n_frames == 0:
+            # no full frame, sliding_window_view would raise
+            return np.zeros((0, self.frame_size), dtype=wave.dtype)
+        frames = np.lib.stride_tricks.sliding_window_view(wave, self.frame_size)
+        return frames[::self.frame_shift][:n_frames]
+
+    def static(self, frames):
+        """log filterbank energies and log energies of frames"""
+        frames = np.array(frames, dtype=np.float64)
+        if self.zero_mean:
+            frames -= frames.mean(axis=1, keepdims=True)
+        energy = np.sum(frames ** 2, axis=1) # raw energy
+        if self.pre_emph > 0:
+            frames[:, 1:] -= self.pre_emph * frames[:, :-1].copy()
+            frames[:, 0] *= 1 - self.pre_emph
+        frames *= self.window
+        if not self.raw_energy:
+            energy = np.sum(frames ** 2, axis=1)
+        spec = np.abs(np.fft.rfft(frames, n=self.fft_size, axis=1))
+        if self.use_power:
+            spec **= 2
+        fbank = np.log(np.maximum(spec.dot(self.fbank), 1.0))
+        log_energy = np.full(len(energy), LZERO)
+        np.log(energy, out=log_energy, where=energy >= MINLARG)
+        return fbank, log_energy
+
+    def finish(self, fbank, log_energy):
+        """features of an utterance from its static features"""
+        if not self.use_energy:
+            x = fbank
+        else:
+            if self.e_normalise and len(log_energy) > 0:
+                e_max = log_energy.max()
+                e_min = e_max - self.sil_floor * np.log(10.0) / 10.0
+                log_energy = 1.0 - (e_max - np.maximum(log_energy, e_min)) * self.e_scale
+            x = np.concatenate([fbank, log_energy[:, np.newaxis]], axis=1)
+        feats = [x]
+        if self.use_delta:
+            feats.append(add_regression(x, self.delta_window))
+            if self.use_accel:
+                feats.append(add_regression(feats[-1], self.accel_window))
+        return np.concatenate(feats, axis=1)
+
+    def __call__(self, waves):
+        """features (#frames X dim) of waves (raw sample values as in the wav
+        files), with the frames of all waves processed at once"""
+        frames = [self.frames(wave) for wave in waves]
+        fbank, log_energy = self.static(np.concatenate(frames))
+        offsets = np.cumsum([0] + [len(f) for f in frames])
+        return [self.finish(fbank[s:e], log_energy[s:e])
+                for s, e in zip(offsets[:-1], offsets[1:])]
@@ -36,18 +36,18 @@ class SequenceWise(nn.Module):
         else:
            T_max = longest_length
 
-        x = torch.cat([x[i, 0 : input_sizes_list[i]] for i in range(len(input_sizes_list))], dim = 0)    # x: T_sum, D
-        x = self.module(x)       # pass the module processing
-        start = 0
-        out = []
-        for length in input_sizes_list:
-           x_i = x[start : start + length]
-           num_pad = T_max - length
-           if num_pad > 0:
-              x_i = F.pad(x_i, pad = (0, 0, 0, num_pad), mode='constant', value = 0)
-           out.append(x_i)
-           start += length
-        out = torch.stack(out, dim = 0)     # N, T, D
+        # gather the valid frames of all sequences with one index_select, and
+        # scatter the module outputs back into a zero-padded tensor with one
+        # index_copy, the indices are those of the frames in the flattened N*T
+        N, T = x.size(0), x.size(1)
+        lengths = torch.as_tensor(input_sizes_list, device = x.device).unsqueeze(1)
+        seqs = torch.arange(N, device = x.device).unsqueeze(1)
+        steps = torch.arange(max(T, T_max), device = x.device).unsqueeze(0)
+        idx_in = (seqs * T + steps[:, :T])[steps[:, :T] < lengths]
+        idx_out = (seqs * T_max + steps[:, :T_max])[steps[:, :T_max] < lengths]
+        x = self.module(x.reshape(N * T, -1).index_select(0, idx_in))    # x: T_sum, D1
+        out = x.new_zeros(N * T_max, x.size(1))
+        out = out.index_copy(0, idx_out, x).view(N, T_max, -1)     # N, T, D1
 
         return out
 
@@ -136,40 +136,77 @@ class Layered_RNN(nn.Module):
 
     def get_embed(self, wav_file, cfg_file):
         htk_feat_file = wav_file[:-4] + '.htk'
-        gpu_dtype = torch.FloatTensor
         if self._HCopy(cfg_file, wav_file) is not None:
             io_src = htk_io.fopen(htk_feat_file)
             utt_feat = io_src.getall()
-            num_frms = utt_feat.shape[0]
             utt_feat -= self.global_mean_emr
             utt_feat /= (np.sqrt(self.global_var_emr) + 1e-8)
-            utt_feat = torch.FloatTensor(utt_feat[np.newaxis, :, :])
-            with torch.no_grad():
-                utt_feat = Variable(utt_feat).type(gpu_dtype)
+            return self.embed(utt_feat)
 
-            x = utt_feat.cuda()
-            for i in range(len(self.rnns)):
-                x = self.rnns[i](x, [num_frms])
+    def embed(self, utt_feat):
+        """get_embed on the features (#frames X 123 array, normalized by the
+        global mean and variance) of one utterance"""
+        num_frms = utt_feat.shape[0]
+        gpu_dtype = torch.FloatTensor
+        utt_feat = torch.FloatTensor(utt_feat[np.newaxis, :, :])
+        with torch.no_grad():
+            utt_feat = Variable(utt_feat).type(gpu_dtype)
 
-            x = self.batch_norm(x, [num_frms])            
+        x = utt_feat.to(next(self.parameters()).device)
+        for i in range(len(self.rnns)):
+            x = self.rnns[i](x, [num_frms])
 
-            x_embed = self.fc(x)
-            x_cls = self.cls(x_embed)
-            x_prob = nn.Softmax(dim=2)(x_cls)
+        x = self.batch_norm(x, [num_frms])            
 
-            x_label = x_prob.max(2)[1].data.cpu().numpy()
-            x_prob = np.squeeze(x_prob.data.cpu().numpy())
-            x_embed = np.squeeze(x_embed.data.cpu().numpy())
+        x_embed = self.fc(x)
+        x_cls = self.cls(x_embed)
+        x_prob = nn.Softmax(dim=2)(x_cls)
 
-            x_ave = torch.cat([torch.mean(x[0, 0:num_frms, :], dim = 0, keepdim = True)], dim = 0)
+        x_label = x_prob.max(2)[1].data.cpu().numpy()
+        x_prob = np.squeeze(x_prob.data.cpu().numpy())
+        x_embed = np.squeeze(x_embed.data.cpu().numpy())
 
-            x_embed_g = self.fc(x_ave)
-            x_cls_g = self.cls(x_embed_g)
-            x_prob_g = nn.Softmax(dim=1)(x_cls_g)
+        x_ave = torch.cat([torch.mean(x[0, 0:num_frms, :], dim = 0, keepdim = True)], dim = 0)
+
+        x_embed_g = self.fc(x_ave)
+        x_cls_g = self.cls(x_embed_g)
+        x_prob_g = nn.Softmax(dim=1)(x_cls_g)
 
-            x_label_g = x_prob_g.max(1)[1].data.cpu().numpy()
-            x_prob_g = np.squeeze(x_prob_g.data.cpu().numpy())
-            x_embed_g = np.squeeze(x_embed_g.data.cpu().numpy())
+        x_label_g = x_prob_g.max(1)[1].data.cpu().numpy()
+        x_prob_g = np.squeeze(x_prob_g.data.cpu().numpy())
+        x_embed_g = np.squeeze(x_embed_g.data.cpu().numpy())
 
         return x_prob, x_embed, x_prob_g, x_embed_g
 
+    def get_embeds(self, feats):
+        """batched get_embed on features (#frames X 123 arrays, normalized
+        by the global mean and variance), returns a (prob, embed, prob_g,
+        embed_g) tuple per utterance"""
+        order = sorted(range(len(feats)), key=lambda i: -feats[i].shape[0])
+        lengths = [feats[i].shape[0] for i in order] # decreasing for packing
+        device = next(self.parameters()).device
+        x = torch.zeros(len(feats), lengths[0], feats[0].shape[1])
+        for row, i in zip(x, order):
+            row[:feats[i].shape[0]] = torch.from_numpy(feats[i])
+        with torch.no_grad():
+            x = x.to(device)
+            for rnn in self.rnns:
+                x = rnn(x, lengths)
+            x = self.batch_norm(x, lengths)
+
+            x_embed = self.fc(x)
+            x_prob = nn.Softmax(dim=2)(self.cls(x_embed))
+
+            # mean over the frames of each utterance, padded frames are 0
+            n_frms = torch.tensor(lengths, dtype=x.dtype, device=device)
+            x_ave = x.sum(dim=1) / n_frms.unsqueeze(1)
+            x_embed_g = self.fc(x_ave)
+            x_prob_g = nn.Softmax(dim=1)(self.cls(x_embed_g))
+
+        x_prob, x_embed = x_prob.cpu().numpy(), x_embed.cpu().numpy()
+        x_prob_g, x_embed_g = x_prob_g.cpu().numpy(), x_embed_g.cpu().numpy()
+        outputs = [None] * len(feats)
+        for j, (i, n) in enumerate(zip(order, lengths)):
+            outputs[i] = (x_prob[j, :n], x_embed[j, :n], x_prob_g[j], x_embed_g[j])
+        return outputs
+
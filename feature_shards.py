@@ -0,0 +1,211 @@
+# Pack per-utterance features (mels, emotion embeddings) of a filelist into
+# one contiguous binary file plus a small offset index, and read them back as
+# zero-copy slices of a memory map.
+#
+# Example:
+#   python feature_shards.py \
+#     --filelist filelists/ljspeech/ljspeech_wav_train.txt \
+#     --output shards/ljspeech_train \
+#     --hparams "load_mel_from_disk=False"
+#
+# Emotion embeddings are read from their .npy files, or from the shard
+# written by prep_emotion.py with --emotion-shard.
+#
+# Shard layout:
+#   <prefix>.bin      raw C-ordered arrays, each starting at an aligned offset
+#   <prefix>.idx.npz  per field: keys, byte offsets, shapes and dtypes
+# While being written, a shard is <prefix>.partial.bin/.partial.idx.npz.
+
+import os
+import argparse
+import numpy as np
+import torch
+
+ALIGN = 64 # byte alignment of each array in the .bin file
+
+
+def read_index(idx_path):
+    """index of a shard, per field a dict of keys to (offset, shape, dtype)"""
+    index = {}
+    with np.load(idx_path) as idx:
+        fields = sorted(set(k.split('/')[0] for k in idx.files))
+        for field in fields:
+            keys = idx['{}/keys'.format(field)]
+            offsets = idx['{}/offsets'.format(field)]
+            shapes = idx['{}/shapes'.format(field)]
+            dtypes = idx['{}/dtypes'.format(field)]
+            index[field] = {str(k): (int(o), tuple(int(d) for d in s if d >= 0), str(t))
+                for k, o, s, t in zip(keys, offsets, shapes, dtypes)}
+    return index
+
+
+def write_index(idx_path, index):
+    """write the index (per field a dict of keys to (offset, shape, dtype))
+    of a shard atomically"""
+    arrays = {}
+    for field, entries in index.items():
+        keys = list(entries.keys())
+        offsets, shapes, dtypes = zip(*entries.values())
+        ndim = max(len(shape) for shape in shapes)
+        shapes = [tuple(shape) + (-1,) * (ndim - len(shape)) for shape in shapes]
+        arrays['{}/keys'.format(field)] = np.array(keys)
+        arrays['{}/offsets'.format(field)] = np.array(offsets, dtype=np.int64)
+        arrays['{}/shapes'.format(field)] = np.array(shapes, dtype=np.int64)
+        arrays['{}/dtypes'.format(field)] = np.array(dtypes)
+    with open(idx_path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(idx_path + '.tmp', idx_path)
+
+
+class ShardWriter():
+    """Append arrays to a shard and write its index on close
+
+    Until then the arrays go to the partial shard <prefix>.partial, whose
+    index is written by checkpoint (and on an exception in a with block), so
+    an interrupted run keeps what it wrote up to its last checkpoint. With
+    resume, the writer continues an existing partial shard.
+    """
+    def __init__(self, prefix, resume=False):
+        self.prefix = prefix
+        self.bin_path = '{}.bin'.format(prefix)
+        self.idx_path = '{}.idx.npz'.format(prefix)
+        self.partial_bin_path = '{}.partial.bin'.format(prefix)
+        self.partial_idx_path = '{}.partial.idx.npz'.format(prefix)
+        dirname = os.path.dirname(prefix)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.index = {}
+        if resume and os.path.isfile(self.partial_idx_path) and \
+            os.path.isfile(self.partial_bin_path):
+            self.index = read_index(self.partial_idx_path)
+            # drop whatever was written after the last checkpoint
+            end = max([offset + int(np.prod(shape)) * np.dtype(dtype).itemsize
+                       for entries in self.index.values()
+                       for offset, shape, dtype in entries.values()] + [0])
+            self.f = open(self.partial_bin_path, 'r+b')
+            self.f.truncate(end)
+            self.f.seek(end)
+        else:
+            self.f = open(self.partial_bin_path, 'wb')
+
+    def has(self, field, key):
+        return field in self.index and key in self.index[field]
+
+    def add(self, field, key, array):
+        array = np.ascontiguousarray(array)
+        offset = self.f.tell()
+        if offset % ALIGN != 0:
+            self.f.write(b'\0' * (ALIGN - offset % ALIGN))
+            offset = self.f.tell()
+        self.f.write(array.tobytes())
+        entries = self.index.setdefault(field, {})
+        entries[key] = (offset, array.shape, array.dtype.str)
+
+    def checkpoint(self):
+        """make the arrays added so far durable in the partial shard"""
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        write_index(self.partial_idx_path, self.index)
+
+    def close(self):
+        self.f.close()
+        os.replace(self.partial_bin_path, self.bin_path)
+        write_index(self.idx_path, self.index)
+        if os.path.isfile(self.partial_idx_path):
+            os.remove(self.partial_idx_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.checkpoint()
+            self.f.close()
+
+
+class FeatureShard():
+    """Read arrays from a shard as zero-copy slices of a memory map
+
+    The memory map is opened lazily, so each DataLoader worker maps the file
+    itself and all workers share the same pages through the OS page cache.
+    """
+    def __init__(self, prefix):
+        self.bin_path = '{}.bin'.format(prefix)
+        self.idx_path = '{}.idx.npz'.format(prefix)
+        self.data = None
+        self.index = read_index(self.idx_path)
+
+    def __getstate__(self):
+        # do not pickle the memory map, it is reopened in the worker
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def has(self, field, key):
+        return field in self.index and key in self.index[field]
+
+    def get(self, field, key):
+        """return the array of a key as torch tensor sharing the mapped pages"""
+        if self.data is None:
+            # copy-on-write mapping, so pages stay shared unless written to
+            self.data = np.memmap(self.bin_path, dtype=np.uint8, mode='c')
+        offset, shape, dtype = self.index[field][key]
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        array = self.data[offset:offset+nbytes].view(dtype).reshape(shape)
+        return torch.from_numpy(array)
+
+    def keys(self, field):
+        return list(self.index.get(field, {}).keys())
+
+
+def pack_filelist(filelist, prefix, hparams, emotion_shard=None):
+    """pack mels (and emotion embeddings if included, from emotion_shard if
+    given) of a filelist"""
+    from data_utils import TextMelLoader
+    shuffle_plan = {'shuffle-audiopath': False, 'shuffle-batch': False,
+        'permute-opt': 'rand', 'pre-batching': False}
+    dataset = TextMelLoader(filelist, shuffle_plan, hparams)
+    dataset.feature_shard = None # always read from the original features
+    nlines = len(dataset.audiopaths_and_text)
+    if emotion_shard is not None:
+        emotion_shard = FeatureShard(emotion_shard)
+    with ShardWriter(prefix) as writer:
+        for i, line in enumerate(dataset.audiopaths_and_text):
+            audiopath, emoembpath, _, _, _, _ = dataset.parse_filelist_line(line)
+            writer.add('mel', audiopath, dataset.get_mel(audiopath).numpy())
+            if dataset.include_emo_emb and emotion_shard is not None:
+                writer.add('emoemb', emoembpath,
+                           emotion_shard.get('emoemb', emoembpath).numpy())
+            elif dataset.include_emo_emb:
+                writer.add('emoemb', emoembpath, np.load(emoembpath))
+            if (i+1) % 1000 == 0:
+                print('{}/{} utterances packed ...'.format(i+1, nlines))
+    print('wrote shard {} ({} utterances)'.format(prefix, nlines))
+
+
+def parse_args():
+    usage = 'pack features of a filelist into one memory-mappable shard'
+    parser = argparse.ArgumentParser(description=usage)
+    parser.add_argument('-f', '--filelist', type=str, required=True,
+                        help='filelist to pack')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='output prefix of the shard (.bin and .idx.npz)')
+    parser.add_argument('--emotion-shard', type=str, default=None,
+                        help='prefix of the emotion shard of prep_emotion.py')
+    parser.add_argument('--hparams', type=str, required=False,
+                        help='comma separated name=value pairs')
+    return parser.parse_args()
+
+
+def main():
+    from hparams import create_hparams
+    args = parse_args()
+    hparams = create_hparams(args.hparams)
+    pack_filelist(args.filelist, args.output, hparams, args.emotion_shard)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,10 +16,20 @@ def create_hparams(hparams_string=None, verbose=False):
         shuffle_audiopaths=True,
         shuffle_batches=True,
         shuffle_samples=False, # exclusive with shuffle_audiopaths and shuffle_batches
-        permute_opt='rand', # 'rand', 'semi-sort', 'bucket', etc.
+        permute_opt='rand', # 'rand', 'semi-sort', 'bucket' or 'bucket-2d' (dur x text length)
         local_rand_factor=0.1, # used when permute_opt == 'semi-sort'
+        bucket_width=1.0, # key (dur or text length) width of buckets if permute_opt == 'bucket'
+        text_bucket_width=20, # text length width of buckets if permute_opt == 'bucket-2d'
         pre_batching=True, # pre batch data, so batch_size is 1 in DataLoader
         prep_trainset_per_epoch=False,
+        num_workers=1, # DataLoader worker processes
+        pin_memory=True, # pin collated batches (ignored without CUDA)
+        prefetch_batches=2, # batches staged on the device ahead of the train loop (0: off)
+        stream_filelist=False, # stream the train filelist lazily instead of loading it
+        stream_buffer_size=10000, # lines per shuffle buffer when streaming
+        step_timing=False, # time data wait, h2d, model parts, backward, optimizer per step
+        rank_skew_interval=100, # steps between gathers of the per-rank compute times (with step_timing, 0: off)
+        data_stall_fraction=0.2, # warn if the data wait is above this fraction of a step
         seed=1234,
         dynamic_loss_scaling=True,
         fp16_run=False,
@@ -35,10 +45,14 @@ def create_hparams(hparams_string=None, verbose=False):
         ################################
         load_mel_from_disk=False, # if true, 1st element in the filelist should be mel
         mel_data_type='numpy', # 'numpy' or 'torch'
+        mel_cache_dir='', # cache computed mels here if not empty (ignored if load_mel_from_disk)
+        batch_mel_extraction=True, # extract mels of a pre-batch in one STFT pass
+        feature_shard='', # prefix of a packed feature shard (see feature_shards.py) to read mels from
         training_files='filelists/soe/3x/soe_wav-emo_v0_train_3x.txt',
         validation_files='filelists/soe/3x/soe_wav-emo_v0_valid_3x.txt',
         filelist_cols=['audiopath','emoembpath','text','dur','speaker','emotion'],
         text_cleaners=['english_cleaners'], # english_cleaners, korean_cleaners
+        text_store_dir='', # keep encoded token sequences of filelists here if not empty
 
         ################################
         # Emotion Embedding Parameters #
@@ -139,6 +153,13 @@ def create_hparams(hparams_string=None, verbose=False):
         weight_decay=1e-6,
         grad_clip_thresh=1.0,
         batch_size=32,
+        batch_budget=0, # max batch size x max key (dur or text length), or max B x T_in x (1 + T_out) with batch_policy 'attention', if pre-batching, 0: auto
+        batch_policy='greedy', # 'greedy', 'optimal' (fewest batches, least padding) or 'attention' (by text and mel lengths), see batch_plan.py
+        balance_ranks=True, # in distributed runs, give the ranks pre-batches of similar area at every step
+        memory_model='', # json of a fitted memory model (see memory_model.py) to batch by memory
+        memory_budget=0, # peak memory (MiB) per batch if pre-batching with memory_model, 0: off
+        track_memory=False, # record the peak memory per step in track.csv and refit memory_model.json from it at checkpoints
+        plan_dir='', # dir to persist epoch plans of samples/batches in and load them from
         mask_padding=True  # set model's padded outputs to padded values
     )
 
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 from librosa.filters import mel as librosa_mel_fn
 from audio_processing import dynamic_range_compression
 from audio_processing import dynamic_range_decompression
@@ -94,3 +95,30 @@ class TacotronSTFT(torch.nn.Module):
         mel_output = torch.matmul(self.mel_basis, magnitudes)
         mel_output = self.spectral_normalize(mel_output)
         return mel_output
+
+    def mel_spectrograms(self, ys):
+        """Computes mel-spectrograms of waves with different lengths in one pass
+        PARAMS
+        ------
+        ys: list of torch.FloatTensor with shape (T_i,) in range [-1, 1]
+
+        RETURNS
+        -------
+        mel_outputs: list of torch.FloatTensor of shape (n_mel_channels, T_i')
+        """
+        assert(min(torch.min(y.data) for y in ys) >= -1)
+        assert(max(torch.max(y.data) for y in ys) <= 1)
+
+        pad = int(self.stft_fn.filter_length / 2)
+        n_frames = [y.size(0) // self.stft_fn.hop_length + 1 for y in ys]
+        # reflect-pad every clip on its own as in STFT.transform, then
+        # zero-pad to the longest clip; the zeros only reach frames beyond
+        # each clip's own frame count, which are cut off below
+        ys_padded = [F.pad(y.view(1, 1, -1), (pad, pad), mode='reflect').view(-1)
+                     for y in ys]
+        ys_padded = torch.nn.utils.rnn.pad_sequence(ys_padded, batch_first=True)
+        magnitudes, phases = self.stft_fn.transform_padded(ys_padded.unsqueeze(1))
+        magnitudes = magnitudes.data
+        mel_outputs = torch.matmul(self.mel_basis, magnitudes)
+        mel_outputs = self.spectral_normalize(mel_outputs)
+        return [mel_output[:, :n] for mel_output, n in zip(mel_outputs, n_frames)]
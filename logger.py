@@ -31,6 +31,25 @@ class Tacotron2Logger(SummaryWriter):
                 self.add_scalar("weighted_kl_loss", kl_weight*kl_div, iteration)
                 self.add_scalar("recon_loss", recon_loss, iteration)
 
+    def log_mel_cache(self, hits, misses, iteration):
+        self.add_scalar("mel.cache.hits", hits, iteration)
+        self.add_scalar("mel.cache.misses", misses, iteration)
+        if hits + misses > 0:
+            self.add_scalar("mel.cache.hit.rate", hits / (hits + misses), iteration)
+
+    def log_step_timing(self, timings, iteration):
+        for phase, seconds in timings.items():
+            self.add_scalar("time.{}".format(phase), seconds, iteration)
+        if timings['step'] > 0:
+            self.add_scalar("data.wait.fraction",
+                            timings['data-wait'] / timings['step'], iteration)
+
+    def log_rank_skew(self, rank_times, iteration):
+        for r, seconds in enumerate(rank_times):
+            self.add_scalar("rank.{}.time".format(r), seconds, iteration)
+        self.add_scalar("rank.skew", (max(rank_times) - min(rank_times)) /
+                        max(rank_times), iteration)
+
     def log_validation(self, reduced_loss, model, y, y_pred, iteration):
         self.add_scalar("validation.loss", reduced_loss, iteration)
         if self.use_vae:
@@ -0,0 +1,65 @@
+import os
+import hashlib
+import multiprocessing
+import numpy as np
+import torch
+
+
+class MelCache():
+    """On-disk, content-addressed cache of mel-spectrograms
+
+    Each entry is keyed by the audio path, its size and mtime, and the
+    STFT/mel parameters, so a changed file or a changed hparam only misses
+    the entries it affects. Entries are stored as .npy files under
+    cache_dir/<key[:2]>/<key>.npy and are written atomically so that several
+    DataLoader workers can fill the cache at the same time.
+    """
+    def __init__(self, cache_dir, stft_params):
+        self.cache_dir = cache_dir
+        self.stft_params = tuple(sorted(stft_params.items()))
+        # counters live in shared memory so that hits/misses made in
+        # DataLoader worker processes are visible in the main process
+        self.hits = multiprocessing.Value('l', 0)
+        self.misses = multiprocessing.Value('l', 0)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, audiopath):
+        st = os.stat(audiopath)
+        key_items = (os.path.abspath(audiopath), st.st_size, st.st_mtime_ns,
+                     self.stft_params)
+        return hashlib.sha1(repr(key_items).encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], '{}.npy'.format(key))
+
+    def load(self, audiopath):
+        """return cached mel (torch.FloatTensor) or None if not cached"""
+        path = self.get_path(self.get_key(audiopath))
+        if os.path.isfile(path):
+            try:
+                melspec = torch.from_numpy(np.load(path))
+            except (ValueError, OSError):
+                # partially written or corrupted entry, recompute it
+                melspec = None
+        else:
+            melspec = None
+        counter = self.misses if melspec is None else self.hits
+        with counter.get_lock():
+            counter.value += 1
+        return melspec
+
+    def save(self, audiopath, melspec):
+        path = self.get_path(self.get_key(audiopath))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        path_tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(path_tmp, 'wb') as f:
+            np.save(f, melspec.numpy(), allow_pickle=False)
+        os.replace(path_tmp, path)
+
+    def get_stats(self, reset=False):
+        """return (hits, misses) since the last reset"""
+        with self.hits.get_lock(), self.misses.get_lock():
+            stats = self.hits.value, self.misses.value
+            if reset:
+                self.hits.value, self.misses.value = 0, 0
+        return stats
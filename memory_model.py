@@ -0,0 +1,111 @@
+# Model of the peak GPU memory of a training step as a function of the batch
+# shape, fitted from the batch-size, max-len-txt, batch-length and mem-peak
+# columns which train.py records in track.csv with hparams.track_memory:
+#
+#   mem = c0 + c1 B T_txt + c2 B T_mel + c3 B T_mel T_txt
+#
+# (B: batch size, T_txt: max text length, T_mel: max mel frames). The last
+# term covers the attention weights kept for every decoder step. The
+# coefficients are fitted with non-negative least squares, so the model is
+# monotone in every dimension and can be used to pack batches up to a
+# memory budget (see batch_plan.plan_memory).
+#
+# Example:
+#   python memory_model.py -t outdir/logdir/track.csv -o outdir/memory_model.json
+
+import json
+import argparse
+import numpy as np
+from scipy.optimize import nnls
+
+TERMS = ['const', 'B*T_txt', 'B*T_mel', 'B*T_mel*T_txt']
+
+
+def get_features(batch_size, text_len, mel_len):
+    batch_size = np.asarray(batch_size, dtype=np.float64)
+    text_len = np.asarray(text_len, dtype=np.float64)
+    mel_len = np.asarray(mel_len, dtype=np.float64)
+    return np.stack([np.ones_like(batch_size), batch_size * text_len,
+        batch_size * mel_len, batch_size * mel_len * text_len], axis=-1)
+
+
+class MemoryModel():
+    """Peak memory (MiB) of a training step given its batch shape"""
+    def __init__(self, coefs, margin=0.0, n_samples=0):
+        self.coefs = np.asarray(coefs, dtype=np.float64)
+        self.margin = margin # added to predictions, max residual of the fit
+        self.n_samples = n_samples
+
+    @classmethod
+    def fit(cls, batch_size, text_len, mel_len, mem_peak):
+        features = get_features(batch_size, text_len, mel_len)
+        mem_peak = np.asarray(mem_peak, dtype=np.float64)
+        # scale the columns so nnls is well conditioned
+        scales = np.abs(features).max(axis=0)
+        scales[scales == 0] = 1
+        coefs, _ = nnls(features / scales, mem_peak)
+        coefs = coefs / scales
+        margin = float(max(0, np.max(mem_peak - features.dot(coefs))))
+        return cls(coefs, margin, len(mem_peak))
+
+    @classmethod
+    def from_track(cls, track, min_samples=20):
+        """fit from a track dict (see train.track_seq), None if too few
+        iterations have the peak memory recorded"""
+        rows = [i for i, m in enumerate(track.get('mem-peak', [])) if m != '']
+        if len(rows) < min_samples:
+            return None
+        columns = [[float(track[k][i]) for i in rows] for k in
+                   ['batch-size', 'max-len-txt', 'batch-length', 'mem-peak']]
+        return cls.fit(*columns)
+
+    def predict(self, batch_size, text_len, mel_len):
+        features = get_features(batch_size, text_len, mel_len)
+        return features.dot(self.coefs) + self.margin
+
+    def __call__(self, batch_size, text_len, mel_len):
+        # scalar version of predict, used per sample by the planner
+        c = self.coefs
+        return c[0] + batch_size * (c[1] * text_len + mel_len * (
+            c[2] + c[3] * text_len)) + self.margin
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'terms': TERMS, 'coefs': self.coefs.tolist(),
+                       'margin': self.margin, 'n_samples': self.n_samples},
+                      f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            params = json.load(f)
+        assert params['terms'] == TERMS, 'unknown terms in {}'.format(path)
+        return cls(params['coefs'], params['margin'], params['n_samples'])
+
+
+def parse_args():
+    usage = 'fit the peak memory model of training steps from track.csv'
+    parser = argparse.ArgumentParser(description=usage)
+    parser.add_argument('-t', '--track', type=str, required=True,
+                        help='track.csv written by train.py')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='output json file of the model')
+    return parser.parse_args()
+
+
+def main():
+    from utils import csv2dict
+    args = parse_args()
+    track = csv2dict(args.track)
+    model = MemoryModel.from_track(track)
+    assert model is not None, 'too few iterations with mem-peak in {}'.format(
+        args.track)
+    print('fitted on {} iterations: {}, margin {:.1f} MiB'.format(
+        model.n_samples, ', '.join('{:.3g} {}'.format(c, t)
+        for c, t in zip(model.coefs, TERMS)), model.margin))
+    model.save(args.output)
+    print('wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
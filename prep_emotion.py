@@ -7,22 +7,43 @@
 #   --stats-emr models/emr_datatang_4emo_trimmed/stats_emr \
 #   --cfg-file emr/htk.cfg \
 #   --out-dim 64 \
-#   --gpu-device 1
+#   --gpu-device 1 \
+#   --output /data/evs/SOE/renamed/emotion
+#
+# The HTK features are computed in process (emr/htk_features.py), for
+# batches of utterances of similar lengths, which go through the model
+# together. All outputs are written to one feature shard (see
+# feature_shards.py), per field keyed by the path of the .npy file they used
+# to be saved to:
+#   emoprob   <wav>_prob.npy     #frames X #ems
+#   emoemb    <wav>_embed.npy    #frames X out_dim
+#   emoprob_g <wav>_prob_g.npy   #ems
+#   emoemb_g  <wav>_embed_g.npy  out_dim
+# Outputs generated before are not generated again: those of an existing
+# output shard, or of .npy files (from --write-npy or older versions of this
+# script), are copied into the new shard. The shard is checkpointed every
+# --checkpoint-secs seconds and when the run fails or is interrupted, and the
+# next run resumes from that partial shard (<output>.partial).
 
 import os, sys
+import time
 import argparse
 import torch
 import numpy as np
 import glob
+from concurrent.futures import ThreadPoolExecutor
+from scipy.io import wavfile
 
-# include HTK libraries (assume in '~/bin')
-os.environ['HTK_ROOT'] = os.path.expanduser('~/bin')
-os.environ['PATH'] = os.environ['HTK_ROOT'] + ':' + os.environ['PATH']
+from feature_shards import ShardWriter, FeatureShard
 
 # include audio emotion recognition directory into search path
 emrpath = os.path.join(os.getcwd(), 'emr')
 sys.path.extend([emrpath])
 from models_embed import Layered_RNN
+from htk_features import HTKFeatures, read_config
+
+FIELDS = {'emoprob': '_prob.npy', 'emoemb': '_embed.npy',
+          'emoprob_g': '_prob_g.npy', 'emoemb_g': '_embed_g.npy'}
 
 def parse_args():
   parser = argparse.ArgumentParser()
@@ -33,8 +54,57 @@ def parse_args():
   parser.add_argument('--cfg-file', type=str, default='emr/htk.cfg')
   parser.add_argument('--out-dim', type=int, default=64)
   parser.add_argument('--gpu-device', type=int, default=0)
+  parser.add_argument('--output', type=str, default='',
+                      help=('prefix of the output shard, default: emotion in'
+                            ' the input dir'))
+  parser.add_argument('--batch-mb', type=float, default=16,
+                      help='max size of a padded batch of wav files in MB')
+  parser.add_argument('--write-npy', action='store_true',
+                      help='also save the outputs to .npy files next to the wavs')
+  parser.add_argument('--checkpoint-secs', type=float, default=60,
+                      help='seconds between checkpoints of the partial shard')
   return parser.parse_args()
 
+def get_batches(wavs, batch_mb):
+  """groups of wavs of similar sizes, whose padded size (#wavs x largest
+  file size) fits batch_mb"""
+  sizes = {wav: os.path.getsize(wav) for wav in wavs}
+  batches, batch = [], []
+  for wav in sorted(wavs, key=lambda w: -sizes[w]):
+    if batch and (len(batch) + 1) * sizes[batch[0]] > batch_mb * 2**20:
+      batches.append(batch)
+      batch = []
+    batch.append(wav)
+  if batch:
+    batches.append(batch)
+  return batches
+
+def get_features(batch, cfg, extractors, mean, var):
+  """normalized HTK features of a batch of wavs, None for wavs shorter than
+  a frame"""
+  waves = {}
+  for wav in batch:
+    sampling_rate, data = wavfile.read(wav)
+    waves.setdefault(sampling_rate, []).append((wav, data))
+  feats = {}
+  for sampling_rate, items in waves.items():
+    if sampling_rate not in extractors:
+      extractors[sampling_rate] = HTKFeatures(cfg, sampling_rate)
+    htk = extractors[sampling_rate]
+    for (wav, _), feat in zip(items, htk([data for _, data in items])):
+      feats[wav] = (feat - mean) / (np.sqrt(var) + 1e-8) if len(feat) > 0 else None
+  return [feats[wav] for wav in batch]
+
+def is_generated(shard, wav):
+  """whether a shard (if not None) has all outputs of a wav"""
+  return shard is not None and all(shard.has(field, wav.replace('.wav', suffix))
+                                   for field, suffix in FIELDS.items())
+
+def is_saved(wav):
+  """whether all outputs of a wav are saved to .npy files"""
+  return all(os.path.isfile(wav.replace('.wav', suffix))
+             for suffix in FIELDS.values())
+
 def main():
 
   # runtime mode
@@ -48,6 +118,9 @@ def main():
   # args.cfg_file = 'emr/htk.cfg'
   # args.out_dim = 64
   # args.gpu_device = 1
+  # args.output = ''
+  # args.batch_mb = 16
+  # args.write_npy = False
 
   print('input dir: {}'.format(args.input_dir))
   print('model file: {}'.format(args.model_file))
@@ -55,6 +128,9 @@ def main():
   print('config file: {}'.format(args.cfg_file))
   print('output dim: {}'.format(args.out_dim))
   print('gpu device: {}'.format(args.gpu_device))
+  if not args.output:
+    args.output = os.path.join(args.input_dir, 'emotion')
+  print('output shard: {}'.format(args.output))
 
   # set current GPU device
   torch.cuda.set_device(args.gpu_device)
@@ -70,39 +146,74 @@ def main():
   wav_paths = os.path.join(args.input_dir, '**', '*.wav')
   wavs = sorted(glob.glob(wav_paths, recursive=True))
 
-  nwavs = len(wavs)
-  for i, wav in enumerate(wavs):
-
-    if os.path.isfile(wav):
-
-      # check if emotion features already generated
-      file = {'preds': wav.replace('.wav', '_prob.npy'),
-              'embeds': wav.replace('.wav', '_embed.npy'),
-              'preds_g': wav.replace('.wav', '_prob_g.npy'),
-              'embeds_g': wav.replace('.wav', '_embed_g.npy')}
-      flags = [os.path.isfile(file['preds']),
-               os.path.isfile(file['embeds']),
-               os.path.isfile(file['preds_g']),
-               os.path.isfile(file['embeds_g'])]
-      if all(flags):
-        print('{}: emotion feature generated, skip!'.format(os.path.basename(wav)))
+  cfg = read_config(args.cfg_file)
+  extractors = {}
+  mean, var = model.global_mean_emr, model.global_var_emr
+  executor = ThreadPoolExecutor(max_workers=1)
+
+  with ShardWriter(args.output, resume=True) as writer:
+    # outputs generated before are kept: those of the partial shard of an
+    # interrupted run are in the writer already, those of an existing shard
+    # (replaced by the new one on close) or of .npy files are copied
+    shard = None
+    if os.path.isfile('{}.idx.npz'.format(args.output)):
+      shard = FeatureShard(args.output)
+    resumed = [wav for wav in wavs if is_generated(writer, wav)]
+    wavs = [wav for wav in wavs if not is_generated(writer, wav)]
+    done = [wav for wav in wavs if is_generated(shard, wav) or is_saved(wav)]
+    wavs = [wav for wav in wavs if not (is_generated(shard, wav) or is_saved(wav))]
+    print('{} wavs resumed from {}.partial, {} already generated, skip!'.format(
+      len(resumed), args.output, len(done)))
+    for wav in done:
+      for field, suffix in FIELDS.items():
+        key = wav.replace('.wav', suffix)
+        if shard is not None and shard.has(field, key):
+          writer.add(field, key, shard.get(field, key).numpy())
+        else:
+          writer.add(field, key, np.load(key))
+    writer.checkpoint()
+
+    nwavs = len(wavs)
+    batches = get_batches(wavs, args.batch_mb)
+    print('{} wavs in {} batches'.format(nwavs, len(batches)))
+
+    # features of the next batch are computed while the model runs
+    if batches:
+      future = executor.submit(get_features, batches[0], cfg, extractors, mean, var)
+
+    start, ndone = time.perf_counter(), 0
+    checkpointed = start
+    for b, batch in enumerate(batches):
+      feats = future.result()
+      if b + 1 < len(batches):
+        future = executor.submit(get_features, batches[b+1], cfg, extractors,
+                                 mean, var)
+      for wav, feat in zip(batch, feats):
+        if feat is None:
+          print('{}: shorter than a frame, skip!'.format(wav))
+      batch = [wav for wav, feat in zip(batch, feats) if feat is not None]
+      feats = [feat for feat in feats if feat is not None]
+      if len(batch) == 0:
         continue
 
-      # preds, preds_g: #frames X #ems, 1 X #ems
-      # embeds, embeds_g: #frames X out_dim, 1 X out_dim
-      outputs = model.get_embed(wav, cfg_file=args.cfg_file)
-      preds, embeds, preds_g, embeds_g = outputs
-
-      # save emotion features
-      np.save(file['preds'], preds)
-      np.save(file['embeds'], embeds)
-      np.save(file['preds_g'], preds_g)
-      np.save(file['embeds_g'], embeds_g)
-      print("({}/{}) {}: generated emb prob {}, embed {}".format(
-        i+1, nwavs, os.path.basename(wav), preds.shape, embeds.shape))
-
-    else:
-      raise Exception('{} does not exist!'.format(wav))
+      # preds, preds_g: #frames X #ems, #ems
+      # embeds, embeds_g: #frames X out_dim, out_dim
+      for wav, outputs in zip(batch, model.get_embeds(feats)):
+        for (field, suffix), output in zip(FIELDS.items(), outputs):
+          writer.add(field, wav.replace('.wav', suffix), output)
+          if args.write_npy:
+            np.save(wav.replace('.wav', suffix), output)
+
+      ndone += len(batch)
+      now = time.perf_counter()
+      print('({}/{}) batch of {} wavs, {:.1f} wavs/s'.format(
+        ndone, nwavs, len(batch), ndone / (now - start)))
+      if now - checkpointed >= args.checkpoint_secs:
+        writer.checkpoint()
+        checkpointed = now
+  executor.shutdown()
+  print('wrote shard {} ({} utterances, {} new)'.format(args.output,
+    len(resumed) + len(done) + ndone, ndone))
 
 if __name__ == '__main__':
   main()
\ No newline at end of file
@@ -8,38 +8,14 @@ import glob
 import random
 import wave
 import contextlib
-
-def convert_symbol(text, l1, l2, quote='"'):
-  """convert symbol l1 to l2 if inside quote"""
-  text2 = ''
-  inside = False
-  for c in text:
-    if c == quote:
-      inside = not inside
-    elif c == l1:
-      if inside:
-        text2 += l2
-      else:
-        text2 += l1
-    else:
-       text2 += c
-  return text2
+import csv
+import struct
+from concurrent.futures import ThreadPoolExecutor
 
 def csv2dict(csvname, delimiter=','):
   """extract rows in csv file to a dictionary list"""
-  lines = open(csvname, 'r').readlines()
-  header = lines[0].rstrip().split(delimiter)
-  lines = lines[1:]
-  nlines = len(lines)
-
-  dict_list = [{} for _ in range(nlines)]
-  for i, line in enumerate(lines):
-    line2 = convert_symbol(line.rstrip(), delimiter, '|')
-    items = line2.split(delimiter)
-    items2 = [s.replace('|', delimiter) for s in items]
-    dict_list[i] = {k:items2[j] for j,k in enumerate(header)}
-
-  return dict_list
+  with open(csvname, 'r', newline='') as f:
+    return list(csv.DictReader(f, delimiter=delimiter))
 
 def read_meta_ljspeech(metafile):
   """read ljspeech metadata.csv to get filename to text mapping"""
@@ -76,20 +52,14 @@ def prep_ljspeech(args, verbose=False):
 
   spk_id, emo_id = 0, 0
   filename2text = read_meta_ljspeech(args.metafile)
-
-  filename2dur = {}
-  batchsize = 1000
-  for i, wavfile in enumerate(wavfiles):
-    if verbose and (i%batchsize == 0):
-      print('getting duration for file {} ~ {}'.format(
-        i, min(i+batchsize, nwavfiles)))
-    basename = os.path.splitext(os.path.basename(wavfile))[0]
-    filename2dur[basename] = wav_duration(wavfile)
+  wav2header = scan_wavs(wavfiles, get_cache_path(args), args.num_threads,
+                         verbose)
 
   lines = ['' for _ in range(len(wavfiles))]
   for i, wavfile in enumerate(wavfiles):
     basename = os.path.splitext(os.path.basename(wavfile))[0]
-    text, dur = filename2text[basename], filename2dur[basename]
+    _, _, frames, rate = wav2header[wavfile]
+    text, dur = filename2text[basename], frames / float(rate)
     if args.include_emb:
       embfile = wavfile.replace('/wavs/', '/embs/')
       embfile = embfile.replace('.wav', '.npy')
@@ -155,14 +125,77 @@ def split(lines, ratio='8:1:1', seed=0, ordered=True):
              in zip(cats, range(len(cats)))}
   return flist
 
-def wav_duration(filename):
-  """get wav file duration in seconds"""
+def wav_header(filename):
+  """get (size, mtime, #frames, sampling rate) of a wav file"""
+  stat = os.stat(filename)
+  with open(filename, 'rb') as f:
+    head = f.read(4096)
+  # walk the RIFF chunks up to the data chunk in the first bytes of the file
+  fmt, pos = None, 12
+  if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+    while pos + 8 <= len(head):
+      chunk_id, chunk_size = struct.unpack_from('<4sI', head, pos)
+      if chunk_id == b'fmt ' and pos + 24 <= len(head):
+        fmt = struct.unpack_from('<HHIIH', head, pos + 8)
+      elif chunk_id == b'data' and fmt is not None and fmt[0] == 1:
+        _, _, rate, _, block_align = fmt
+        return (stat.st_size, stat.st_mtime_ns, chunk_size // block_align, rate)
+      pos += 8 + chunk_size + chunk_size % 2
+  # otherwise (e.g. extensible format, long headers) let wave parse it
   with contextlib.closing(wave.open(filename,'r')) as f:
-    frames = f.getnframes()
-    rate = f.getframerate()
-    duration = frames / float(rate)
-    #print(duration)
-  return duration
+    return (stat.st_size, stat.st_mtime_ns, f.getnframes(), f.getframerate())
+
+def cached_wav_header(filename, cache):
+  """wav header from cache if the file size and mtime did not change"""
+  header = cache.get(filename)
+  if header is not None:
+    stat = os.stat(filename)
+    if header[:2] == (stat.st_size, stat.st_mtime_ns):
+      return header
+  return wav_header(filename)
+
+def get_cache_path(args):
+  if args.cache:
+    return args.cache
+  return os.path.join(args.output_dir, args.dataset, 'wav_headers.txt')
+
+def load_wav_cache(cache_path):
+  """read the cache of wav path|size|mtime|#frames|rate lines"""
+  cache = {}
+  if os.path.isfile(cache_path):
+    with open(cache_path, 'r', encoding='utf-8') as f:
+      for line in f:
+        parts = line.rstrip('\n').split('|')
+        if len(parts) == 5:
+          cache[parts[0]] = tuple(int(x) for x in parts[1:])
+  return cache
+
+def save_wav_cache(cache_path, wav2header):
+  os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+  cache_path_tmp = '{}.{}.tmp'.format(cache_path, os.getpid())
+  with open(cache_path_tmp, 'w', encoding='utf-8') as f:
+    for wavfile, header in wav2header.items():
+      f.write('|'.join([wavfile] + [str(x) for x in header]) + '\n')
+  os.replace(cache_path_tmp, cache_path)
+
+def scan_wavs(wavfiles, cache_path, num_threads=32, verbose=False):
+  """get (size, mtime, #frames, rate) of wav files by reading their headers
+  in a thread pool, or from the cache at cache_path for unchanged files, and
+  update the cache"""
+  cache = load_wav_cache(cache_path)
+  # chunks of files per task, a future per file would cost more than a stat
+  chunksize = 1000
+  chunks = [wavfiles[i:i+chunksize] for i in range(0, len(wavfiles), chunksize)]
+  with ThreadPoolExecutor(max_workers=num_threads) as executor:
+    headers = executor.map(
+      lambda chunk: [cached_wav_header(f, cache) for f in chunk], chunks)
+    wav2header = dict(zip(wavfiles, (h for hs in headers for h in hs)))
+  if verbose:
+    nchanged = sum(cache.get(f) != h for f, h in wav2header.items())
+    print('read {} wav headers, {} cached in {}'.format(
+      nchanged, len(wavfiles) - nchanged, cache_path))
+  save_wav_cache(cache_path, wav2header)
+  return wav2header
 
 def sort_by_dur(lines, reverse=True):
   """sort lines by duration (as one item in the line)"""
@@ -216,6 +249,11 @@ def parse_args():
   parser.add_argument('--ordered', action='store_true',
                       help=('file list will be sorted after randomization'
                             ' if specified'))
+  parser.add_argument('--num-threads', type=int, default=32,
+                      help='threads reading wav headers')
+  parser.add_argument('--cache', type=str, default='',
+                      help=('cache of wav headers, default: wav_headers.txt'
+                            ' in the output directory of the dataset'))
 
   return parser.parse_args()
 
@@ -230,6 +268,8 @@ def main():
   # args.seed = 0
   # args.ordered = False
   # args.output_dir = r'filelists'
+  # args.num_threads = 32
+  # args.cache = ''
   #
   # # ljspeech
   # args.input_dir = r'data/LJSpeech-1.1/wavs'
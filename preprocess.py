@@ -2,36 +2,70 @@ import argparse
 import os
 from multiprocessing import cpu_count
 from tqdm import tqdm
-from datasets import ljspeech, soe
+from datasets import ljspeech, soe, common
 from hparams import create_hparams
+from utils import load_filepaths_and_text
 
 hparams = create_hparams()
 
 
 def preprocess_ljspeech(args):
   in_dir = os.path.join(args.base_dir, 'LJSpeech-1.1')
-  out_dir = os.path.join(in_dir, args.output)
+  out_dir = get_out_dir(args)
   os.makedirs(out_dir, exist_ok=True)
-  metadata = ljspeech.build_from_path(in_dir, out_dir, args.num_workers, tqdm=tqdm)
-  write_metadata(metadata, out_dir)
+  metadata = ljspeech.build_from_path(in_dir, out_dir, args.num_workers,
+                                      tqdm=tqdm, shard=args.shard)
+  write_metadata(metadata, out_dir, args.shard)
 
 
 def preprocess_soe(args):
   in_dir = os.path.join(args.base_dir, 'SOE', 'renamed')
-  out_dir = os.path.join(in_dir, args.output).rstrip(os.sep)
+  out_dir = get_out_dir(args)
   os.makedirs(out_dir, exist_ok=True)
-  metadata = soe.build_from_path(in_dir, out_dir, args.num_workers, tqdm=tqdm)
+  metadata = soe.build_from_path(in_dir, out_dir, args.num_workers,
+                                 tqdm=tqdm, shard=args.shard)
+  write_metadata(metadata, out_dir, args.shard)
+
+
+def get_out_dir(args):
+  if args.dataset == 'ljspeech':
+    return os.path.join(args.base_dir, 'LJSpeech-1.1', args.output)
+  return os.path.join(args.base_dir, 'SOE', 'renamed', args.output).rstrip(os.sep)
+
+
+def merge_shards(args):
+  '''combine the mels.txt fragments and manifests of the n shards into
+  mels.txt and manifest.txt'''
+  out_dir, n_shards = get_out_dir(args), args.merge
+  metadata, entries = [], []
+  for i in range(n_shards):
+    shard = (i, n_shards)
+    fragment = os.path.join(out_dir, common.get_shard_name('mels.txt', shard))
+    manifest = os.path.join(out_dir, common.get_shard_name('manifest.txt', shard))
+    assert os.path.isfile(fragment), '{} is missing, has shard {}/{} run?'.format(
+      fragment, i, n_shards)
+    metadata += [(m[0], int(m[1]), m[2]) for m in load_filepaths_and_text(fragment)]
+    entries += list(common.load_manifest(manifest).values())
+  # shards are interleaved by hash, restore a deterministic order
+  metadata.sort()
+  entries.sort()
+  common.save_manifest(os.path.join(out_dir, 'manifest.txt'), entries)
   write_metadata(metadata, out_dir)
 
 
-def write_metadata(metadata, out_dir):
-  with open(os.path.join(out_dir, 'mels.txt'), 'w', encoding='utf-8') as f:
+def write_metadata(metadata, out_dir, shard=None):
+  mels_txt = os.path.join(out_dir, common.get_shard_name('mels.txt', shard))
+  with open(mels_txt, 'w', encoding='utf-8') as f:
     for m in metadata:
       f.write('|'.join([str(x) for x in m]) + '\n')
+  if not metadata:
+    print('Wrote 0 utterances to %s' % mels_txt)
+    return
   frames = sum([m[1] for m in metadata])
   #hours = frames * hparams.frame_shift_ms / (3600 * 1000)
   hours = frames * hparams.hop_length / hparams.sampling_rate / 3600
-  print('Wrote %d utterances, %d frames (%.2f hours)' % (len(metadata), frames, hours))
+  print('Wrote %d utterances, %d frames (%.2f hours) to %s' % (
+    len(metadata), frames, hours, mels_txt))
   print('Max input length (#words in normalized text):  %d' %
         max(len(m[2]) for m in metadata))
   print('Max output length: %d (#frames in spectrogram)' % max(m[1] for m in metadata))
@@ -44,9 +78,20 @@ def parse_args():
   parser.add_argument('--output', default='')
   parser.add_argument('--dataset', required=True, choices=['ljspeech', 'soe'])
   parser.add_argument('--num_workers', type=int, default=cpu_count())
+  parser.add_argument('--shard', type=parse_shard, default=None,
+                      help='i/n: process only shard i of n (0 <= i < n)')
+  parser.add_argument('--merge', type=int, default=0,
+                      help='n: combine the outputs of shards 0/n ... n-1/n')
   return parser.parse_args()
 
 
+def parse_shard(shard):
+  i, n = [int(x) for x in shard.split('/')]
+  if not 0 <= i < n:
+    raise argparse.ArgumentTypeError('shard {} is not in 0/n ... n-1/n'.format(shard))
+  return (i, n)
+
+
 def main():
 
   # runtime mode
@@ -59,7 +104,9 @@ def main():
   # args.dataset = 'soe' # 'ljspeech', or 'soe'
   # args.num_workers = cpu_count()
 
-  if args.dataset == 'ljspeech':
+  if args.merge:
+    merge_shards(args)
+  elif args.dataset == 'ljspeech':
     preprocess_ljspeech(args)
   elif args.dataset == 'soe':
     preprocess_soe(args)
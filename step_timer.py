@@ -0,0 +1,110 @@
+# Per-iteration breakdown of a training step into phases: waiting for the
+# DataLoader, host-to-device copies, the model components, backward and the
+# optimizer.
+#
+# Usage in the train loop:
+#   timer = StepTimer(model)
+#   for batch in train_loader:
+#       timer.data_ready()
+#       timer.start('h2d'); x, y = model.parse_batch(batch); timer.stop('h2d')
+#       (or timer.add('h2d', seconds) for copies timed elsewhere, e.g. by
+#       BatchPrefetcher ahead of the step)
+#       ...
+#       timings = timer.end_step() # seconds per phase
+#       ... (logging, validation)
+#       timer.reset()
+#
+# Device phases are timed with CUDA events on the current stream, so nothing
+# is synchronized until end_step, which waits for the last event only. The
+# data wait is host time from reset to the next batch, and the step time is
+# the data wait plus host time from data_ready to end_step. The compute time
+# is the device time from data_ready to the gradient allreduce in
+# distributed runs (to the end of backward otherwise), i.e. the work of the
+# rank before it waits for the others.
+
+import time
+import torch
+
+PHASES = ['data-wait', 'h2d', 'encoder', 'vae-gst', 'decoder', 'postnet',
+          'forward', 'backward', 'optimizer', 'compute', 'step']
+
+
+class StepTimer():
+    """Time the phases of training steps, model components through forward
+    hooks on the submodules in modules. All methods are no-ops if not enabled.
+    """
+    def __init__(self, model=None, modules=('encoder', 'vae_gst', 'decoder',
+                                            'postnet'), enabled=True):
+        self.enabled = enabled
+        self.use_cuda = torch.cuda.is_available()
+        self.active = False
+        self.marks, self.open, self.added = [], {}, []
+        self.handles = []
+        if model is not None and enabled:
+            for name in modules:
+                module = getattr(model, name, None)
+                if module is None:
+                    continue
+                phase = name.replace('_', '-')
+                self.handles.append(module.register_forward_pre_hook(
+                    lambda m, inputs, phase=phase: self.start(phase)))
+                self.handles.append(module.register_forward_hook(
+                    lambda m, inputs, outputs, phase=phase: self.stop(phase)))
+        self.reset()
+
+    def reset(self):
+        """start timing the data wait for the next batch"""
+        self.wait_start = time.perf_counter()
+
+    def mark(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def start(self, phase):
+        if self.active:
+            self.open[phase] = self.mark()
+
+    def stop(self, phase):
+        if self.active and phase in self.open:
+            self.marks.append((phase, self.open.pop(phase), self.mark()))
+
+    def data_ready(self):
+        """a batch arrived, the other phases of the step start now"""
+        self.step_start = time.perf_counter()
+        self.data_wait = self.step_start - self.wait_start
+        self.marks, self.open = [], {}
+        self.added = []
+        self.active = self.enabled
+
+    def add(self, phase, seconds):
+        """add seconds timed outside the step to a phase"""
+        if self.active:
+            self.added.append((phase, seconds))
+
+    def end_step(self):
+        """return seconds spent per phase in the step since data_ready, or
+        None if not enabled"""
+        self.active = False
+        if not self.enabled:
+            return None
+        if self.use_cuda and len(self.marks) > 0:
+            self.marks[-1][2].synchronize()
+        timings = {phase: 0.0 for phase in PHASES}
+        for phase, start, end in self.marks:
+            if self.use_cuda:
+                timings[phase] += start.elapsed_time(end) / 1000
+            else:
+                timings[phase] += end - start
+        for phase, seconds in self.added:
+            timings[phase] += seconds
+        timings['data-wait'] = self.data_wait
+        timings['step'] = self.data_wait + time.perf_counter() - self.step_start
+        return timings
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
@@ -88,6 +88,11 @@ class STFT(torch.nn.Module):
             mode='reflect')
         input_data = input_data.squeeze(1)
 
+        return self.transform_padded(input_data)
+
+    def transform_padded(self, input_data):
+        """transform input which is already padded by filter_length/2 on both
+        sides, input_data: (B, 1, T + filter_length)"""
         forward_transform = F.conv1d(
             input_data,
             Variable(self.forward_basis, requires_grad=False),
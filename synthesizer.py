@@ -29,7 +29,7 @@ from layers import TacotronSTFT
 from train import load_model
 from text import text_to_sequence
 
-from utils import load_wav_to_torch
+from utils import load_wav_norm
 from scipy.io.wavfile import write
 import os
 import time
@@ -56,11 +56,10 @@ class Synthesizer(object):
             self.hparams.mel_fmax)
 
     def load_mel(self, path):
-        audio, sampling_rate = load_wav_to_torch(path)
+        audio_norm, sampling_rate = load_wav_norm(path, self.hparams.max_wav_value)
         if sampling_rate != self.hparams.sampling_rate:
             raise ValueError("{} SR doesn't match target {} SR".format(
                 sampling_rate, self.stft.sampling_rate))
-        audio_norm = audio / self.hparams.max_wav_value
         audio_norm = audio_norm.unsqueeze(0)
         audio_norm = torch.autograd.Variable(audio_norm, requires_grad=False)
         melspec = self.stft.mel_spectrogram(audio_norm)
@@ -0,0 +1,93 @@
+import os
+import hashlib
+import numpy as np
+
+from text import text_to_sequence
+from text.symbols import symbols
+
+
+def hash_text(text):
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+    return np.frombuffer(digest, dtype=np.uint64)[0]
+
+
+class TextSequenceStore():
+    """Token sequences of the texts in a filelist, encoded once and kept on disk
+
+    The store file is named after the filelist and a key of the cleaner names
+    and the symbol table, so changing either starts a new store. Entries are
+    looked up by a 64-bit hash of the raw text, and update() only encodes the
+    texts which are not in the store yet, e.g. lines added to the filelist.
+    """
+    def __init__(self, store_dir, filelist, cleaner_names):
+        self.cleaner_names = cleaner_names
+        key_items = (tuple(cleaner_names), tuple(symbols))
+        key = hashlib.sha1(repr(key_items).encode('utf-8')).hexdigest()[:16]
+        name = '{}.{}.npz'.format(os.path.basename(filelist), key)
+        self.path = os.path.join(store_dir, name)
+        if os.path.isfile(self.path):
+            with np.load(self.path) as store:
+                self.hashes = store['hashes'] # sorted
+                self.offsets = store['offsets']
+                self.lengths = store['lengths']
+                self.tokens = store['tokens']
+        else:
+            self.hashes = np.zeros(0, dtype=np.uint64)
+            self.offsets = np.zeros(0, dtype=np.int64)
+            self.lengths = np.zeros(0, dtype=np.int64)
+            self.tokens = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def find(self, text_hash):
+        i = np.searchsorted(self.hashes, text_hash)
+        if i < len(self.hashes) and self.hashes[i] == text_hash:
+            return i
+        return None
+
+    def get(self, text):
+        """return int32 token array of text, or None if not in the store"""
+        i = self.find(hash_text(text))
+        if i is None:
+            return None
+        offset = self.offsets[i]
+        return self.tokens[offset:offset+self.lengths[i]]
+
+    def update(self, texts, verbose=True):
+        """encode texts which are not in the store and save the store"""
+        new_hashes, new_seqs = [], []
+        seen = set()
+        for text in texts:
+            text_hash = hash_text(text)
+            if text_hash in seen or self.find(text_hash) is not None:
+                continue
+            seen.add(text_hash)
+            new_hashes.append(text_hash)
+            new_seqs.append(text_to_sequence(text, self.cleaner_names))
+        if len(new_hashes) == 0:
+            return 0
+
+        lengths = np.array([len(seq) for seq in new_seqs], dtype=np.int64)
+        offsets = len(self.tokens) + np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        tokens = np.fromiter((t for seq in new_seqs for t in seq),
+                             dtype=np.int32, count=int(lengths.sum()))
+        hashes = np.concatenate([self.hashes, np.array(new_hashes, dtype=np.uint64)])
+        order = np.argsort(hashes, kind='stable')
+        self.hashes = hashes[order]
+        self.offsets = np.concatenate([self.offsets, offsets])[order]
+        self.lengths = np.concatenate([self.lengths, lengths])[order]
+        self.tokens = np.concatenate([self.tokens, tokens])
+        self.save()
+        if verbose:
+            print('encoded {} new texts into {} ({} in total)'.format(
+                len(new_hashes), self.path, len(self)))
+        return len(new_hashes)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        path_tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(path_tmp, 'wb') as f:
+            np.savez(f, hashes=self.hashes, offsets=self.offsets,
+                     lengths=self.lengths, tokens=self.tokens)
+        os.replace(path_tmp, self.path)
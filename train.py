@@ -2,6 +2,7 @@ import os
 import sys
 import time
 import argparse
+import inspect
 import math
 from numpy import finfo
 import imageio
@@ -10,16 +11,18 @@ sys.path.append(os.getcwd())
 import torch
 from distributed import apply_gradient_allreduce
 import torch.distributed as dist
-from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data import DataLoader
 
 from model import Tacotron2
-from data_utils import TextMelLoader, TextMelCollate
+from data_utils import TextMelLoader, TextMelStream, TextMelCollate, TextMelSampler
+from data_utils import FrameBudgetBatchSampler, BatchPrefetcher
 from plotting_utils import plot_scatter, plot_tsne, plot_kl_weight
 from utils import get_kl_weight, get_text_padding_rate, get_mel_padding_rate
 from utils import dict2col, dict2row, list2csv, csv2dict, flatten_list
 from loss_function import Tacotron2Loss_VAE, Tacotron2Loss
 from logger import Tacotron2Logger
+from step_timer import StepTimer, PHASES
+from memory_model import MemoryModel
 
 from hparams import create_hparams, hparams_debug_string # for LJSpeech
 #from hparams_soe import create_hparams, hparams_debug_string # for SOE
@@ -32,6 +35,21 @@ def reduce_tensor(tensor, n_gpus):
     return rt
 
 
+def gather_scalar(value, n_gpus):
+    """list of the value of every rank"""
+    t = torch.tensor([value], device='cuda')
+    gathered = [torch.zeros_like(t) for _ in range(n_gpus)]
+    dist.all_gather(gathered, t)
+    return [g.item() for g in gathered]
+
+
+def min_scalar(value):
+    """min of the value over the ranks"""
+    t = torch.tensor([value], device='cuda')
+    dist.all_reduce(t, op=dist.reduce_op.MIN)
+    return int(t.item())
+
+
 def init_distributed(hparams, n_gpus, rank, group_name):
     assert torch.cuda.is_available(), "Distributed mode requires CUDA."
     print("Initializing Distributed")
@@ -47,39 +65,61 @@ def init_distributed(hparams, n_gpus, rank, group_name):
     print("Done initializing distributed")
 
 
-def prepare_dataloaders(hparams, epoch=0, valset=None, collate_fn=None):
-    # Get data, data loaders and collate function ready
+def prepare_dataloaders(hparams, n_gpus=1, rank=0):
+    # Get data, data loaders and collate function ready. They live across
+    # epochs, only the plan of samples/batches is recomputed per epoch by
+    # train_sampler.set_epoch
 
     # prepare train set
-    print('preparing train set for epoch {}'.format(epoch))
+    print('preparing train set')
     shuffle_train = {'shuffle-audiopath': hparams.shuffle_audiopaths,
         'shuffle-batch': hparams.shuffle_batches, 'permute-opt': hparams.permute_opt,
         'pre-batching': hparams.pre_batching}
-    trainset = TextMelLoader(hparams.training_files, shuffle_train,
-                             hparams, epoch)
-    #print('\n'.join(['{}, {}'.format(line[0],line[2]) for line in \
-    #                 trainset.audiopaths_and_text[:5]]))
-    if valset is None:
-        # prepare val set (different shuffle plan compared with train set)
-        print('preparing val set for epoch {}'.format(epoch))
-        shuffle_val = {'shuffle-audiopath': hparams.shuffle_audiopaths,
-            'shuffle-batch': False, 'permute-opt': 'rand', 'pre-batching': False}
-        valset = TextMelLoader(hparams.validation_files, shuffle_val, hparams)
-    if collate_fn is None:
-        collate_fn = {'train': TextMelCollate(hparams, pre_batching=hparams.pre_batching),
-                      'val': TextMelCollate(hparams, pre_batching=False)}
-
-    if hparams.distributed_run:
-        train_sampler = DistributedSampler(trainset, shuffle=hparams.shuffle_samples)
+    num_replicas = n_gpus if hparams.distributed_run else 1
+    if hparams.stream_filelist:
+        trainset = TextMelStream(hparams.training_files, shuffle_train, hparams,
+                                 num_replicas=num_replicas, rank=rank)
+    else:
+        trainset = TextMelLoader(hparams.training_files, shuffle_train, hparams)
+    # prepare val set (different shuffle plan compared with train set)
+    print('preparing val set')
+    shuffle_val = {'shuffle-audiopath': hparams.shuffle_audiopaths,
+        'shuffle-batch': False, 'permute-opt': 'rand', 'pre-batching': False}
+    valset = TextMelLoader(hparams.validation_files, shuffle_val, hparams)
+    pin_memory = hparams.pin_memory and torch.cuda.is_available()
+    collate_fn = {'train': TextMelCollate(hparams),
+                  'val': TextMelCollate(hparams, pre_batching=False)}
+
+    loader_kwargs = {'num_workers': hparams.num_workers,
+        'pin_memory': pin_memory,
+        'collate_fn': collate_fn['train']}
+    loader_kwargs.update(persistent_workers_kwargs(hparams.num_workers))
+    if hparams.stream_filelist:
+        # the dataset shards, shuffles and (if pre-batching) batches itself
+        train_sampler = trainset
+        batch_size = None if hparams.pre_batching else hparams.batch_size
+        train_loader = DataLoader(trainset, batch_size=batch_size,
+                                  drop_last=not hparams.pre_batching, **loader_kwargs)
+    elif hparams.pre_batching:
+        train_sampler = FrameBudgetBatchSampler(trainset,
+            shuffle=hparams.shuffle_samples, num_replicas=num_replicas, rank=rank,
+            balanced=hparams.balance_ranks)
+        train_loader = DataLoader(trainset, batch_sampler=train_sampler,
+                                  **loader_kwargs)
     else:
-        train_sampler = None
+        train_sampler = TextMelSampler(trainset, shuffle=hparams.shuffle_samples,
+                                       num_replicas=num_replicas, rank=rank)
+        train_loader = DataLoader(trainset, sampler=train_sampler,
+            batch_size=hparams.batch_size, drop_last=True, **loader_kwargs)
+    return train_loader, train_sampler, valset, collate_fn
 
-    shuffle = (train_sampler is None) and hparams.shuffle_samples
-    batch_size = 1 if hparams.pre_batching else hparams.batch_size
-    train_loader = DataLoader(trainset, num_workers=1, shuffle=shuffle,
-        sampler=train_sampler, batch_size=batch_size, pin_memory=False,
-        drop_last=True, collate_fn=collate_fn['train'])
-    return train_loader, valset, collate_fn
+
+def persistent_workers_kwargs(num_workers):
+    # keep DataLoader workers alive across epochs (supported since torch 1.7)
+    if num_workers > 0 and \
+        'persistent_workers' in inspect.signature(DataLoader).parameters:
+        return {'persistent_workers': True}
+    return {}
 
 
 def prepare_directories_and_logger(output_directory, log_directory, rank,
@@ -129,9 +169,9 @@ def load_checkpoint(checkpoint_path, model, optimizer):
     optimizer.load_state_dict(checkpoint_dict['optimizer'])
     learning_rate = checkpoint_dict['learning_rate']
     iteration = checkpoint_dict.get('iteration', 0)
-    epoch = checkpoint_dict.get('epoch', 0)
+    epoch = checkpoint_dict.get('epoch') # None in legacy checkpoints
     step = checkpoint_dict.get('step', 0)
-    if epoch == 0:
+    if epoch is None:
         print("Loaded checkpoint '{}' from iter {}" .format(
             checkpoint_path, iteration))
     else:
@@ -151,7 +191,20 @@ def save_checkpoint(model, optimizer, learning_rate, iteration, epoch, step, fil
                 'learning_rate': learning_rate}, filepath)
 
 
-def track_seq(track, input_lengths, gate_padded, metadata, verbose=False):
+def save_memory_model(track, output_directory):
+    # refit the peak memory model of the batch shapes seen so far
+    memory_model = MemoryModel.from_track(track)
+    if memory_model is not None:
+        memory_model.save(os.path.join(output_directory, 'memory_model.json'))
+
+
+def track_timings(track, timings):
+    for phase, seconds in timings.items():
+        track['time-{}'.format(phase)].append(seconds)
+
+
+def track_seq(track, input_lengths, gate_padded, metadata, verbose=False,
+              track_memory=False):
     padding_rate_txt, max_len_txt, top_len_txt = get_text_padding_rate(input_lengths)
     padding_rate_mel, max_len_mel, top_len_mel = get_mel_padding_rate(gate_padded)
     batch_size, batch_length = gate_padded.shape
@@ -159,6 +212,10 @@ def track_seq(track, input_lengths, gate_padded, metadata, verbose=False):
     mem_all = torch.cuda.memory_allocated() / (1024**2)
     mem_cached = torch.cuda.memory_cached() / (1024**2)
     mem_use = mem_all + mem_cached
+    # peak since the reset at the start of the step, only if tracked
+    mem_peak = ''
+    if track_memory:
+        mem_peak = torch.cuda.max_memory_allocated() / (1024**2)
     duration, iteration, epoch, step = metadata
     if verbose:
         print('{} ({}:{}) {:.1f}Sec, '.format(
@@ -183,6 +240,7 @@ def track_seq(track, input_lengths, gate_padded, metadata, verbose=False):
     track['mem-use'].append(mem_use)
     track['mem-all'].append(mem_all)
     track['mem-cached'].append(mem_cached)
+    track['mem-peak'].append(mem_peak)
     track['duration'].append(duration)
     track['iteration'].append(iteration)
     track['epoch'].append(epoch)
@@ -195,7 +253,8 @@ def validate(model, criterion, valset, iteration, batch_size, n_gpus, collate_fn
     model.eval()
     #torch.set_grad_enabled(False)
     with torch.no_grad():
-        val_sampler = DistributedSampler(valset) if distributed_run else None
+        num_replicas = n_gpus if distributed_run else 1
+        val_sampler = TextMelSampler(valset, num_replicas=num_replicas, rank=rank)
         batch_size = 1 if pre_batching else batch_size
         val_loader = DataLoader(valset, sampler=val_sampler, num_workers=1,
                                 shuffle=False, batch_size=batch_size,
@@ -287,14 +346,17 @@ def train(output_directory, log_directory, checkpoint_path, warm_start, n_gpus,
     logger = prepare_directories_and_logger(
         output_directory, log_directory, rank, hparams.use_vae)
 
-    train_loader, valset, collate_fn = prepare_dataloaders(hparams)
+    train_loader, train_sampler, valset, collate_fn = prepare_dataloaders(
+        hparams, n_gpus, rank)
     valset_csv = os.path.join(output_directory, log_directory, 'valset.csv')
     # list2csv(flatten_list(valset.audiopaths_and_text), valset_csv, delimiter='|')
-    list2csv(valset.audiopaths_and_text, valset_csv, delimiter='|')
+    list2csv([valset.audiopaths_and_text[i] for i in valset.get_plan()],
+             valset_csv, delimiter='|')
 
     # Load checkpoint if one exists
     iteration = 0
     epoch_offset = 0
+    start_step = 0 # first batch of the first epoch, > 0 when resuming mid-epoch
     if checkpoint_path is not None:
         if warm_start:
             model = warm_start_model(
@@ -304,14 +366,20 @@ def train(output_directory, log_directory, checkpoint_path, warm_start, n_gpus,
                 load_checkpoint(checkpoint_path, model, optimizer)
             if hparams.use_saved_learning_rate:
                 learning_rate = _learning_rate
-            if epoch == 0:
-                iteration += 1  # next iteration is iteration + 1
-                epoch_offset = max(0, int(iteration / len(train_loader)))
+            iteration += 1  # next iteration is iteration + 1
+            if epoch is None:
+                # legacy checkpoint, only its iteration tells where it was
+                if hparams.stream_filelist:
+                    epoch_offset = 0 # number of batches per epoch unknown
+                else:
+                    epoch_offset = max(0, int(iteration / len(train_loader)))
             else:
                 epoch_offset = epoch
-            print('epoch offset: {}'.format(epoch_offset))
-            train_loader = prepare_dataloaders(hparams, epoch_offset, valset,
-                collate_fn['train'])[0]
+                if not hparams.stream_filelist:
+                    # continue after the checkpointed batch of the epoch
+                    start_step = step + 1
+            print('epoch offset: {}, start step: {}'.format(epoch_offset,
+                                                           start_step))
         print('completing loading model ...')
 
     model.train()
@@ -321,44 +389,89 @@ def train(output_directory, log_directory, checkpoint_path, warm_start, n_gpus,
     track_header = ['padding-rate-txt', 'max-len-txt', 'top-len-txt',
         'padding-rate-mel', 'max-len-mel', 'top-len-mel', 'batch-size',
         'batch-length', 'batch-area', 'mem-use', 'mem-all', 'mem-cached',
-        'duration', 'iteration', 'epoch', 'step']
+        'mem-peak', 'duration', 'iteration', 'epoch', 'step']
+    if hparams.step_timing:
+        track_header += ['time-{}'.format(phase) for phase in PHASES]
     if os.path.isfile(track_csv) and checkpoint_path is not None:
         print('loading existing {} ...'.format(track_csv))
         track = csv2dict(track_csv, header=track_header)
     else:
         track = {k:[] for k in track_header}
 
+    # stage the next batches on the device while the current one is trained
+    if hparams.prefetch_batches > 0:
+        train_batches = BatchPrefetcher(train_loader, hparams.prefetch_batches)
+    else:
+        train_batches = train_loader
+    timer = StepTimer(model, enabled=hparams.step_timing)
+    rank_time, rank_steps = 0.0, 0 # compute time of this rank since the last gather
+    if hparams.distributed_run:
+        model.allreduce_pre_hooks.append(lambda: timer.stop('compute'))
+
     print('start training in epoch {} ~ {} ...'.format(epoch_offset, hparams.epochs))
-    nbatches = len(train_loader)
     for epoch in range(epoch_offset, hparams.epochs):
         #if epoch >= 10: break
+        if start_step > 0:
+            # jump to batch start_step of the (persisted) plan of the epoch
+            if hparams.pre_batching:
+                train_sampler.set_epoch(epoch, start_step)
+            else:
+                train_sampler.set_epoch(epoch, start_step * hparams.batch_size)
+        else:
+            train_sampler.set_epoch(epoch)
+        max_steps = None
+        if hparams.stream_filelist:
+            nbatches = '?'
+            if hparams.distributed_run:
+                # the shards of the ranks differ in #batches, every rank
+                # stops after the fewest, so none waits forever for the
+                # others in a collective op
+                max_steps = min_scalar(
+                    train_sampler.count_batches(hparams.num_workers))
+                nbatches = max_steps
+        else:
+            nbatches = start_step + len(train_loader)
         print("Epoch: {}, #batches: {}".format(epoch, nbatches))
-        batch_sizes, batch_lengths = [0] * nbatches, [0] * nbatches
-        for i, batch in enumerate(train_loader):
+        timer.reset()
+        for i, batch in enumerate(train_batches, start_step):
+            if max_steps is not None and i >= max_steps:
+                break
+            timer.data_ready()
+            timer.start('compute')
             start = time.perf_counter()
             for param_group in optimizer.param_groups:
                 param_group['lr'] = learning_rate
 
             model.zero_grad()
-            x, y = model.parse_batch(batch)
+            if hparams.track_memory:
+                torch.cuda.reset_peak_memory_stats()
+            if hparams.prefetch_batches > 0:
+                # already on the device, copied by the prefetcher on its stream
+                timer.add('h2d', train_batches.h2d_time)
+                x, y = model.parse_batch(batch)
+            else:
+                timer.start('h2d')
+                x, y = model.parse_batch(batch)
+                timer.stop('h2d')
+            timer.start('forward')
             y_pred = model(x)
 
             if hparams.use_vae:
                 loss, recon_loss, kl, kl_weight = criterion(y_pred, y, iteration)
             else:
                 loss = criterion(y_pred, y)
+            timer.stop('forward')
 
-            if hparams.distributed_run:
-                reduced_loss = reduce_tensor(loss.data, n_gpus).item()
-            else:
-                reduced_loss = loss.item()
-
+            timer.start('backward')
             if hparams.fp16_run:
                 with amp.scale_loss(loss, optimizer) as scaled_loss:
                     scaled_loss.backward()
             else:
                 loss.backward()
+            timer.stop('backward')
+            timer.stop('compute') # stopped at the allreduce if distributed
 
+            timer.start('optimizer')
             if hparams.fp16_run:
                 grad_norm = torch.nn.utils.clip_grad_norm_(
                     amp.master_params(optimizer), hparams.grad_clip_thresh)
@@ -368,24 +481,58 @@ def train(output_directory, log_directory, checkpoint_path, warm_start, n_gpus,
                     model.parameters(), hparams.grad_clip_thresh)
 
             optimizer.step()
+            timer.stop('optimizer')
+            timings = timer.end_step()
+
+            # after the gradient allreduce, so it does not time the wait for
+            # the slowest rank
+            if hparams.distributed_run:
+                reduced_loss = reduce_tensor(loss.data, n_gpus).item()
+            else:
+                reduced_loss = loss.item()
+
+            # mean compute time of every rank over the last steps, gathered
+            # every rank_skew_interval steps only
+            rank_times = None
+            if hparams.distributed_run and timings is not None:
+                rank_time += timings['compute']
+                rank_steps += 1
+                if rank_steps == hparams.rank_skew_interval:
+                    rank_times = gather_scalar(rank_time / rank_steps, n_gpus)
+                    rank_time, rank_steps = 0.0, 0
 
             if not is_overflow and rank == 0:
                 duration = time.perf_counter() - start
-                batch_sizes[i], batch_lengths[i] = batch[0].size(0), batch[2].size(2)
-                batch_capacity = batch_sizes[i] * batch_lengths[i]
+                batch_size, batch_length = batch[0].size(0), batch[2].size(2)
+                batch_capacity = batch_size * batch_length
                 mem_all = torch.cuda.memory_allocated() / (1024**2)
                 mem_cached = torch.cuda.memory_cached() / (1024**2)
                 mem_use = mem_all + mem_cached
                 print("{} ({}:{}/{}): ".format(iteration, epoch, i, nbatches), end='')
-                print("Batch {} ({}X{}) ".format(batch_capacity, batch_sizes[i],
-                    batch_lengths[i]), end='')
+                print("Batch {} ({}X{}) ".format(batch_capacity, batch_size,
+                    batch_length), end='')
                 print("Mem {:.1f} ({:.1f}+{:.1f}) ".format(mem_use, mem_all,
                     mem_cached), end='')
                 print("Train loss {:.3f} Grad Norm {:.3f} {:.2f}s/it".format(
                     reduced_loss, grad_norm, duration))
                 input_lengths, gate_padded = batch[1], batch[4]
                 metadata = (duration, iteration, epoch, i)
-                track_seq(track, input_lengths, gate_padded, metadata)
+                track_seq(track, input_lengths, gate_padded, metadata,
+                          track_memory=hparams.track_memory)
+                if rank_times is not None:
+                    skew = (max(rank_times) - min(rank_times)) / max(rank_times)
+                    print("Rank compute times {} (skew {:.0f}%)".format(
+                        ' '.join('{:.2f}s'.format(t) for t in rank_times),
+                        skew*100))
+                    logger.log_rank_skew(rank_times, iteration)
+                if timings is not None:
+                    track_timings(track, timings)
+                    logger.log_step_timing(timings, iteration)
+                    wait_fraction = timings['data-wait'] / timings['step']
+                    if wait_fraction > hparams.data_stall_fraction:
+                        print("Warning: data stall, waited {:.3f}s for the "
+                              "batch ({:.0f}% of the step)".format(
+                              timings['data-wait'], wait_fraction*100))
                 padding_rate_txt = track['padding-rate-txt'][-1]
                 max_len_txt = track['max-len-txt'][-1]
                 padding_rate_mel = track['padding-rate-mel'][-1]
@@ -415,6 +562,8 @@ def train(output_directory, log_directory, checkpoint_path, warm_start, n_gpus,
                         "checkpoint_{}-{}-{}_{:.3f}".format(iteration, epoch, i, val_loss))
                     save_checkpoint(model, optimizer, learning_rate, iteration,
                          epoch, i, checkpoint_path)
+                    if hparams.track_memory:
+                        save_memory_model(track, output_directory)
                     if hparams.use_vae:
                         image_scatter_path = os.path.join(output_directory,
                              "checkpoint_{0}_scatter_val.png".format(iteration))
@@ -424,11 +573,15 @@ def train(output_directory, log_directory, checkpoint_path, warm_start, n_gpus,
                         imageio.imwrite(image_tsne_path, plot_tsne(mus, emotions))
 
             iteration += 1
-
-        if hparams.prep_trainset_per_epoch:
-            train_loader = prepare_dataloaders(hparams, epoch+1, valset,
-                collate_fn['train'])[0]
-            nbatches = len(train_loader)
+            timer.reset()
+        start_step = 0
+
+        mel_cache = train_loader.dataset.mel_cache
+        if mel_cache is not None and rank == 0:
+            hits, misses = mel_cache.get_stats(reset=True)
+            print("Epoch {} mel cache: {} hits, {} misses".format(
+                epoch, hits, misses))
+            logger.log_mel_cache(hits, misses, iteration)
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -5,6 +5,9 @@ import torch
 import os
 import csv
 
+from batch_plan import get_capacity, plan_batches, plan_memory
+from batch_plan import get_attention_capacity, plan_attention
+
 max_wav_value=32768.0
 
 def get_mask_from_lengths(lengths):
@@ -16,8 +19,19 @@ def get_mask_from_lengths(lengths):
 
 
 def load_wav_to_torch(full_path):
-    sampling_rate, data = read(full_path)
-    return torch.FloatTensor(data.astype(np.float32)), sampling_rate
+    sampling_rate, data = read(full_path, mmap=True)
+    return torch.from_numpy(data.astype(np.float32)), sampling_rate
+
+
+def load_wav_norm(full_path, max_wav_value=max_wav_value, start=0, end=None):
+    """load samples [start, end) of a wav file normalized by max_wav_value
+
+    The PCM data is memory-mapped and converted and normalized into a single
+    float32 array, so only the requested range is read and copied once.
+    """
+    sampling_rate, data = read(full_path, mmap=True)
+    audio = np.divide(data[start:end], max_wav_value, dtype=np.float32)
+    return torch.from_numpy(audio), sampling_rate
 
 
 def load_filepaths_and_text(filename, split="|"):
@@ -90,23 +104,6 @@ def get_mel_padding_rate(gate_padded, top_n=3):
     return padding_rate, max_len, top_len
 
 
-def add_rand_noise(key_values, noise_range=(-0.5,0.5), seed=0):
-    n = len(key_values)
-    np.random.seed(seed)
-    values = np.random.rand(n)
-    lower, upper = noise_range
-    noises = [v * (upper-lower) + lower for v in values]
-    key_values_with_noise = [d+n for (d,n) in zip(key_values, noises)]
-    return key_values_with_noise
-
-
-def sort_with_noise(key_values, key_values_noisy, reverse=True):
-    """order clean key values with the order sorted by noisy key values"""
-    idx = [i[0] for i in sorted(enumerate(key_values_noisy),
-                                key=lambda x:x[1], reverse=reverse)]
-    key_values_resorted = [key_values[i] for i in idx]
-    return key_values_resorted
-
 def get_key_values(filelist, filelist_cols):
     if 'dur' in filelist_cols:
         key = 'dur'
@@ -119,45 +116,126 @@ def get_key_values(filelist, filelist_cols):
     return key_values, key
 
 
-def get_batch_sizes(filelist, filelist_cols, batch_size):
+def get_batch_sizes(filelist, filelist_cols, batch_size, batch_capacity=None,
+                    policy='greedy'):
+    """sizes of batches of the filelist in its order which fit batch_capacity
+    (batch size x longest key value), see batch_plan for the policies"""
     key_values, key = get_key_values(filelist, filelist_cols)
-    values_sorted = sorted(key_values, reverse=True)
-    batch_len_max_mean = np.mean(values_sorted[:batch_size])
-    batch_capacity = batch_size * batch_len_max_mean
-    # get batches where each batch gets full capacity
-    batch_sizes = []
-    remaining = key_values[:]
-    while len(remaining) > 0:
-        bs = 1
-        while np.max(remaining[:min(bs, len(remaining))]) * bs <= batch_capacity:
-            bs += 1
-        batch_size_current = min(bs-1, len(remaining))
-        batch_sizes.append(batch_size_current)
-        remaining = remaining[batch_size_current:]
-    return batch_sizes
-
-
-def permute_filelist(filelist, filelist_cols, seed=0, permute_opt='rand',
-                     local_rand_factor=0.1):
+    if not batch_capacity:
+        batch_capacity = get_capacity(key_values, batch_size)
+    return plan_batches(key_values, batch_capacity, policy)
+
+
+def get_text_mel_lengths(filelist, filelist_cols, frames_per_sec):
+    """text lengths (characters) and mel lengths (frames, estimated from
+    the durations) of a filelist"""
+    assert 'dur' in filelist_cols, 'mel lengths are estimated from durations'
+    text_idx, dur_idx = filelist_cols.index('text'), filelist_cols.index('dur')
+    text_lengths = np.fromiter((len(line[text_idx]) for line in filelist),
+                               dtype=np.float64, count=len(filelist))
+    mel_lengths = np.fromiter((float(line[dur_idx]) for line in filelist),
+                              dtype=np.float64, count=len(filelist))
+    return text_lengths, mel_lengths * frames_per_sec
+
+
+def get_memory_batch_sizes(filelist, filelist_cols, frames_per_sec,
+                           memory_model, memory_budget):
+    """sizes of batches of the filelist in its order whose peak memory, as
+    predicted by memory_model from text length and mel frames, fits
+    memory_budget (MiB)"""
+    text_lengths, mel_lengths = get_text_mel_lengths(filelist, filelist_cols,
+                                                     frames_per_sec)
+    return plan_memory(text_lengths, mel_lengths, memory_model, memory_budget)
+
+
+def get_attention_batch_sizes(filelist, filelist_cols, frames_per_sec,
+                              batch_size, batch_capacity=None):
+    """sizes of batches of the filelist in its order whose attention cost
+    B x T_in x (1 + T_out) fits batch_capacity, by default batch_size x the
+    mean cost of the batch_size costliest samples"""
+    text_lengths, mel_lengths = get_text_mel_lengths(filelist, filelist_cols,
+                                                     frames_per_sec)
+    if not batch_capacity:
+        batch_capacity = get_attention_capacity(text_lengths, mel_lengths,
+                                                batch_size)
+    return plan_attention(text_lengths, mel_lengths, batch_capacity)
+
+
+def permute_idxs(key_values, seed=0, permute_opt='rand', local_rand_factor=0.1,
+                 bucket_width=1.0, text_values=None, text_bucket_width=20):
+    """get a permutation of samples with key values (durations or text
+    lengths) as an index array
+
+    rand       random order
+    semi-sort  descending order of the key values plus uniform noise within
+               +/- local_rand_factor/2 x the range of the key values
+    bucket     samples are grouped into buckets of bucket_width key values
+               and shuffled within and across buckets
+    bucket-2d  as bucket, with buckets of bucket_width key values (durations)
+               x text_bucket_width text lengths
+    """
+    key_values = np.asarray(key_values, dtype=np.float64)
+    n = len(key_values)
+    rng = np.random.RandomState(seed)
+    noise_range = (0, 0)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), noise_range
     if permute_opt == 'rand':
-        filelist_permuted = filelist[:]
-        np.random.seed(seed)
-        np.random.shuffle(filelist_permuted)
-        key, noise_range = '', (0,0)
+        idxs_permuted = rng.permutation(n)
     elif permute_opt == 'semi-sort':
-        key_values, key = get_key_values(filelist, filelist_cols)
-        idx_value_sorted = sorted(enumerate(key_values), key=lambda x:x[1], reverse=True)
-        idxs_sorted = [x[0] for x in idx_value_sorted]
-        filelist_sorted = [filelist[i] for i in idxs_sorted]
-        values_sorted = [x[1] for x in idx_value_sorted]
+        # stable on ties, i.e. the same order as sorting (index, value) pairs
+        idxs_sorted = np.argsort(-key_values, kind='stable')
+        values_sorted = key_values[idxs_sorted]
         values_range = np.floor(values_sorted[-1]), np.ceil(values_sorted[0])
         noise_upper = (values_range[1] - values_range[0]) * local_rand_factor
         noise_range = -noise_upper/2, noise_upper/2
-        values_sorted_noisy = add_rand_noise(values_sorted, noise_range, seed=seed)
-        filelist_permuted = sort_with_noise(filelist_sorted, values_sorted_noisy)
-        # # plot to verify semi-sorted order
-        # keys_permuted = [len(line[key_idx].split()) for line in filelist_permuted]
-        # plt.plot(keys_permuted), plt.savefig('verify.png')
+        lower, upper = noise_range
+        noises = rng.rand(n) * (upper-lower) + lower
+        idxs_permuted = idxs_sorted[np.argsort(-(values_sorted + noises),
+                                               kind='stable')]
+    elif permute_opt in ['bucket', 'bucket-2d']:
+        buckets = np.floor(key_values / bucket_width).astype(np.int64)
+        buckets -= buckets.min()
+        if permute_opt == 'bucket-2d':
+            text_values = np.asarray(text_values, dtype=np.float64)
+            text_buckets = np.floor(text_values / text_bucket_width).astype(np.int64)
+            text_buckets -= text_buckets.min()
+            buckets = buckets * (int(text_buckets.max()) + 1) + text_buckets
+            # only keep the occupied buckets
+            buckets = np.unique(buckets, return_inverse=True)[1]
+        bucket_order = rng.permutation(int(buckets.max()) + 1)[buckets]
+        # integer part: buckets in random order, fraction: random order
+        # within each bucket
+        idxs_permuted = np.argsort(bucket_order + rng.rand(n))
+    else:
+        raise ValueError('unknown permute option {}'.format(permute_opt))
+    return idxs_permuted, noise_range
+
+
+def permute_filelist_idxs(filelist, filelist_cols, seed=0, permute_opt='rand',
+                          local_rand_factor=0.1, bucket_width=1.0,
+                          text_bucket_width=20):
+    """get the permuted order of a filelist as an array of line indices"""
+    key_values, key = get_key_values(filelist, filelist_cols)
+    text_values = None
+    if permute_opt == 'rand':
+        key = ''
+    elif permute_opt == 'bucket-2d':
+        assert key == 'dur', "'bucket-2d' needs durations in the filelist"
+        text_idx = filelist_cols.index('text')
+        text_values = [len(line[text_idx]) for line in filelist]
+    idxs_permuted, noise_range = permute_idxs(key_values, seed, permute_opt,
+        local_rand_factor, bucket_width, text_values, text_bucket_width)
+    return idxs_permuted, (key, noise_range)
+
+
+def permute_filelist(filelist, filelist_cols, seed=0, permute_opt='rand',
+                     local_rand_factor=0.1, bucket_width=1.0,
+                     text_bucket_width=20):
+    idxs_permuted, (key, noise_range) = permute_filelist_idxs(filelist,
+        filelist_cols, seed, permute_opt, local_rand_factor, bucket_width,
+        text_bucket_width)
+    filelist_permuted = [filelist[i] for i in idxs_permuted]
     return filelist_permuted, (key, noise_range)
 
 # import matplotlib.pyplot as plt
@@ -176,16 +254,16 @@ def batching(filelist, batch_size):
     if isinstance(batch_size, list):
         # loop over various batch sizes
         num_batch_size = len(batch_size)
-        filelist_remaining = filelist[:]
-        idx = 0
+        num_files = len(filelist)
+        start, idx = 0, 0
         filelist_batched = []
-        while len(filelist_remaining) > batch_size[idx % num_batch_size]:
+        while num_files - start > batch_size[idx % num_batch_size]:
             batch_size_selected = batch_size[idx % num_batch_size]
-            filelist_batched.append(filelist_remaining[:batch_size_selected])
-            filelist_remaining = filelist_remaining[batch_size_selected:]
+            filelist_batched.append(filelist[start:start+batch_size_selected])
+            start += batch_size_selected
             idx += 1
-        if len(filelist_remaining) > 0:
-            filelist_batched.append(filelist_remaining)
+        if num_files - start > 0:
+            filelist_batched.append(filelist[start:])
     else:
         # use fixed batch size
         num_files = len(filelist)
@@ -193,7 +271,8 @@ def batching(filelist, batch_size):
         filelist_batched = [filelist[i * batch_size:(i + 1) * batch_size] for i in
                             range(num_batches)]
         filelist_last = filelist[num_batches * batch_size:]
-        filelist_batched += filelist_last
+        if len(filelist_last) > 0:
+            filelist_batched.append(filelist_last)
     return filelist_batched
 
 # for i, batch in enumerate(filelist_batched):
@@ -295,7 +374,8 @@ def csv2dlist(csvname, delimiter=','):
 def dlist2dict(dlist, header=None):
     if not header:
         header = sorted(dlist[0].keys())
-    dct = {k:[dlist[i][k] for i in range(len(dlist))] for k in header}
+    # columns missing in the csv (e.g. added later) are filled with ''
+    dct = {k:[dlist[i].get(k, '') for i in range(len(dlist))] for k in header}
     return dct
 
 def csv2dict(csvname, delimiter=',', header=None):
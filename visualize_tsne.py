@@ -10,7 +10,7 @@ from train import load_model
 
 from text import text_to_sequence
 
-from utils import load_wav_to_torch
+from utils import load_wav_norm
 from scipy.io.wavfile import write
 import os
 import time
@@ -40,11 +40,10 @@ stft = TacotronSTFT(
             hparams.mel_fmax)
 
 def load_mel(path):
-  audio, sampling_rate = load_wav_to_torch(path)
+  audio_norm, sampling_rate = load_wav_norm(path, hparams.max_wav_value)
   if sampling_rate != hparams.sampling_rate:
     raise ValueError("{} SR doesn't match target {} SR".format(
       sampling_rate, stft.sampling_rate))
-  audio_norm = audio / hparams.max_wav_value
   audio_norm = audio_norm.unsqueeze(0)
   audio_norm = torch.autograd.Variable(audio_norm, requires_grad=False)
   melspec = stft.mel_spectrogram(audio_norm)